@@ -0,0 +1,284 @@
+''' benchmarks of the trie and of the RLP codec
+
+usage:
+
+    python benchmarks/run.py [--size 10000] [--backend leveldb]
+        [--only update,get] [--output results.json]
+        [--baseline baseline.json] [--tolerance 0.1]
+
+every benchmark runs on a new database in a temporary directory, which is
+removed afterwards. the results are written as JSON, per benchmark: the
+ops per second, the p50 and p99 latency of an op in microseconds and the
+database reads and writes per op. a results file saved before a change
+can be passed as --baseline, the ops per second are then compared with it
+and the exit status is 1 if a benchmark got slower by more than
+--tolerance
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import db
+import rlp
+import trie
+import utils
+import workloads
+
+ROOT_HASH_BATCH = 100 # updates flushed by each root_hash op
+
+
+class Run(object):
+    ''' the latencies and database operations of one benchmark '''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.latencies = []
+
+    def start(self):
+        ''' start counting, after the setup of the benchmark '''
+        self.backend.reads = self.backend.writes = 0
+
+    def time(self, func, *args):
+        start = default_timer()
+        result = func(*args)
+        self.latencies.append(default_timer() - start)
+        return result
+
+    def result(self):
+        latencies = sorted(self.latencies)
+        ops = len(latencies)
+
+        def percentile(q):
+            return latencies[int(round(q * (ops - 1)))] * 1e6
+
+        return {
+            'ops': ops,
+            'ops_per_sec': ops / max(sum(latencies), 1e-9),
+            'p50_us': percentile(0.5),
+            'p99_us': percentile(0.99),
+            'db_reads_per_op': float(self.backend.reads) / ops,
+            'db_writes_per_op': float(self.backend.writes) / ops,
+        }
+
+
+def build(database, items, **kwargs):
+    t = trie.Trie(database, **kwargs)
+    with t.batch():
+        for k, v in items:
+            t.update(k, v)
+    return t
+
+
+def bench_update(database, items, run):
+    t = trie.Trie(database)
+    run.start()
+    for k, v in items:
+        run.time(t.update, k, v)
+
+
+def bench_get(database, items, run):
+    t = build(database, items)
+    keys = [k for k, _ in items]
+    random.Random(len(keys)).shuffle(keys)
+    # a new trie, so the node cache starts empty
+    t = trie.Trie(database, t.root_hash)
+    run.start()
+    for k in keys:
+        run.time(t.get, k)
+
+
+def bench_delete(database, items, run):
+    t = build(database, items)
+    run.start()
+    for k, _ in items:
+        run.time(t.delete, k)
+
+
+def bench_root_hash(database, items, run):
+    t = trie.Trie(database, defer_hashing=True)
+    for i in xrange(0, len(items), ROOT_HASH_BATCH):
+        for k, v in items[i:i + ROOT_HASH_BATCH]:
+            t.update(k, v)
+        if i == 0:
+            run.start()
+        run.time(t.get_root_hash)
+
+
+def bench_iterate(database, items, run):
+    t = build(database, items)
+    t = trie.Trie(database, t.root_hash)
+    it = t.iteritems()
+    run.start()
+    for _ in items:
+        run.time(next, it)
+
+
+def bench_to_dict(database, items, run):
+    t = build(database, items)
+    run.start()
+    for _ in range(3):
+        run.time(t.to_dict)
+
+
+def bench_len(database, items, run):
+    t = build(database, items)
+    t = trie.Trie(database, t.root_hash)
+    run.start()
+    for _ in xrange(1000):
+        run.time(len, t)
+
+
+def stored_nodes(database, items):
+    build(database, items)
+    return [v for k, v in database.iterate() if len(k) == 32]
+
+
+def bench_rlp_decode(database, items, run):
+    nodes = stored_nodes(database, items)
+    run.start()
+    for rlpnode in nodes:
+        run.time(rlp.decode, rlpnode)
+
+
+def bench_rlp_encode(database, items, run):
+    nodes = [rlp.decode(rlpnode)
+             for rlpnode in stored_nodes(database, items)]
+    run.start()
+    for node in nodes:
+        run.time(rlp.encode, node)
+
+
+TRIE_BENCHMARKS = [
+    ('update', bench_update),
+    ('get', bench_get),
+    ('delete', bench_delete),
+    ('root_hash', bench_root_hash),
+    ('iterate', bench_iterate),
+    ('to_dict', bench_to_dict),
+    ('len', bench_len),
+]
+CODEC_BENCHMARKS = [
+    ('rlp_decode', bench_rlp_decode),
+    ('rlp_encode', bench_rlp_encode),
+]
+
+
+def benchmarks():
+    ''' (name, function, keys, value size) of all benchmarks '''
+    for keys, value_size in workloads.WORKLOADS:
+        for name, func in TRIE_BENCHMARKS:
+            yield name, func, keys, value_size
+    keys, value_size = workloads.WORKLOADS[0]
+    for name, func in CODEC_BENCHMARKS:
+        yield name, func, keys, value_size
+
+
+def run_benchmark(func, items, scheme, tmpdir):
+    path = tempfile.mkdtemp(dir=tmpdir)
+    backend = workloads.CountingBackend(
+        db.backends[scheme](os.path.join(path, 'db')))
+    run = Run(backend)
+    try:
+        func(db.DB(backend), items, run)
+    finally:
+        shutil.rmtree(path)
+    return run.result()
+
+
+def compare(results, baseline, tolerance):
+    ''' the change of the ops per second of every benchmark in both runs
+
+    :return: (comparison, names of the benchmarks slower than tolerance)
+    '''
+    comparison, regressions = {}, []
+    for name, result in sorted(results.iteritems()):
+        if name not in baseline:
+            continue
+        before = baseline[name]['ops_per_sec']
+        change = result['ops_per_sec'] / before - 1
+        comparison[name] = {'baseline_ops_per_sec': before, 'change': change}
+        if change < -tolerance:
+            regressions.append(name)
+    return comparison, regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='benchmarks of the trie and of the RLP codec')
+    parser.add_argument('--size', type=int, default=10000,
+                        help='items per workload')
+    parser.add_argument('--seed', default='0')
+    parser.add_argument('--backend', default='leveldb',
+                        choices=sorted(db.backends))
+    parser.add_argument('--only', default='',
+                        help='comma separated benchmark names to run')
+    parser.add_argument('--output', help='JSON file, default stdout')
+    parser.add_argument('--baseline', help='JSON file of an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='slowdown of the ops per second which fails '
+                             'the comparison with the baseline')
+    args = parser.parse_args(argv)
+    only = set(filter(None, args.only.split(',')))
+
+    results = {}
+    tmpdir = tempfile.mkdtemp(prefix='trie-bench-')
+    try:
+        for name, func, keys, value_size in benchmarks():
+            if only and name not in only:
+                continue
+            full_name = '%s/%s/v%d' % (name, keys, value_size)
+            items = workloads.items(args.seed, keys, value_size, args.size)
+            result = run_benchmark(func, items, args.backend, tmpdir)
+            results[full_name] = result
+            sys.stderr.write(
+                '%-28s %12.0f ops/s p50 %9.1fus p99 %9.1fus '
+                'reads/op %7.2f writes/op %7.2f\n'
+                % (full_name, result['ops_per_sec'], result['p50_us'],
+                   result['p99_us'], result['db_reads_per_op'],
+                   result['db_writes_per_op']))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'backend': args.backend,
+            'size': args.size,
+            'seed': args.seed,
+            'sha3_backend': utils.SHA3_BACKEND,
+        },
+        'results': results,
+    }
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        report['comparison'], regressions = compare(
+            results, baseline, args.tolerance)
+        for name, change in sorted(report['comparison'].iteritems()):
+            sys.stderr.write('%-28s %+7.1f%%%s\n' % (
+                name, change['change'] * 100,
+                '  REGRESSION' if name in regressions else ''))
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
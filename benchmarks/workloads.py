@@ -0,0 +1,88 @@
+''' synthetic workloads of the benchmarks
+
+the keys and values are drawn from a random.Random seeded by the run, so
+every run with the same seed and size uses the same data
+'''
+import random
+import struct
+
+
+def random_keys(rand, count):
+    ''' random 32 bytes keys, as hashed state keys '''
+    return [''.join(chr(rand.randrange(256)) for _ in range(32))
+            for _ in xrange(count)]
+
+
+def sequential_keys(rand, count):
+    ''' 8 bytes big endian counters, as block numbers '''
+    start = rand.randrange(2 ** 32)
+    return [struct.pack('>Q', start + i) for i in xrange(count)]
+
+
+def prefix_keys(rand, count):
+    ''' 32 bytes keys in 16 groups sharing 20 bytes prefixes, as the
+    storage of a few contracts
+    '''
+    prefixes = [''.join(chr(rand.randrange(256)) for _ in range(20))
+                for _ in range(16)]
+    return [rand.choice(prefixes) +
+            ''.join(chr(rand.randrange(256)) for _ in range(12))
+            for _ in xrange(count)]
+
+
+KEYS = {
+    'random32': random_keys,
+    'sequential': sequential_keys,
+    'prefix': prefix_keys,
+}
+
+# (keys, value size), the first one is also used for the codec benchmarks
+WORKLOADS = [
+    ('random32', 32),
+    ('sequential', 32),
+    ('prefix', 32),
+    ('random32', 4),
+    ('random32', 1024),
+]
+
+
+def items(seed, keys, value_size, count):
+    ''' the (key, value) items of a workload, without duplicate keys '''
+    rand = random.Random('%s/%s/%d/%d' % (seed, keys, value_size, count))
+    key_list = list(set(KEYS[keys](rand, count)))
+    rand.shuffle(key_list)
+    return [(k, ''.join(chr(rand.randrange(1, 256))
+                        for _ in range(value_size)))
+            for k in key_list]
+
+
+class CountingBackend(object):
+    ''' a database backend counting the reads and writes that reach it,
+    see db.DB for the backend interface
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.reads = self.writes = 0
+
+    def get(self, key):
+        self.reads += 1
+        return self.backend.get(key)
+
+    def put(self, key, value):
+        self.writes += 1
+        self.backend.put(key, value)
+
+    def delete(self, key):
+        self.writes += 1
+        self.backend.delete(key)
+
+    def write_batch(self, puts, deletes=(), sync=False):
+        puts, deletes = list(puts), list(deletes)
+        self.writes += len(puts) + len(deletes)
+        self.backend.write_batch(puts, deletes, sync)
+
+    def iterate(self, prefix=''):
+        for k, v in self.backend.iterate(prefix):
+            self.reads += 1
+            yield k, v
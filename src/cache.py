@@ -0,0 +1,91 @@
+PREV, NEXT, KEY, VALUE, SIZE = range(5)
+
+
+class LRUCache(object):
+    ''' least recently used cache with a budget of entries and/or bytes
+
+    usage:
+
+        cache = LRUCache(max_entries=1024, max_bytes=16 * 1024 * 1024)
+        cache.put(key, value, len(value))
+        cache.get(key)
+
+    the items are kept in a circular doubly linked list of
+    [prev, next, key, value, size] links, most recently used at the end
+    '''
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        '''
+        :param max_entries: max number of items, None for no limit
+        :param max_bytes: max sum of the item sizes, None for no limit
+        '''
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.links = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None, 0]
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        link = self.links.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        # move the link to the most recently used end
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+        last = self.root[PREV]
+        last[NEXT] = self.root[PREV] = link
+        link[PREV] = last
+        link[NEXT] = self.root
+        return link[VALUE]
+
+    def put(self, key, value, size=0):
+        '''
+        :param size: size of the item in bytes, counted against `max_bytes`
+        '''
+        self.pop(key)
+        if self.max_entries == 0 or \
+                (self.max_bytes is not None and size > self.max_bytes):
+            return
+        last = self.root[PREV]
+        link = [last, self.root, key, value, size]
+        last[NEXT] = self.root[PREV] = self.links[key] = link
+        self.bytes += size
+        self.evict()
+
+    def evict(self):
+        ''' drop least recently used items until the cache is within budget,
+        call it after changing `max_entries` or `max_bytes`
+        '''
+        while (self.max_entries is not None and
+               len(self.links) > self.max_entries) or \
+                (self.max_bytes is not None and self.bytes > self.max_bytes):
+            self.pop(self.root[NEXT][KEY])
+
+    def pop(self, key):
+        link = self.links.pop(key, None)
+        if link is None:
+            return None
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+        self.bytes -= link[SIZE]
+        return link[VALUE]
+
+    def clear(self):
+        self.links.clear()
+        self.root[:] = [self.root, self.root, None, None, 0]
+        self.bytes = 0
+
+    def stats(self):
+        return dict(entries=len(self.links), bytes=self.bytes,
+                    hits=self.hits, misses=self.misses)
+
+    def __contains__(self, key):
+        return key in self.links
+
+    def __len__(self):
+        return len(self.links)
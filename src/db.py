@@ -1,51 +1,308 @@
-import leveldb
+import itertools
+import os
+import sqlite3
 import threading
+import cache
+import metrics
+import segment
+
+try:
+    import leveldb
+except ImportError:
+    leveldb = None
 
 databases = {}
 
 
+class MemoryBackend(object):
+    ''' a plain dict, nothing is written to disk
+    '''
+
+    def __init__(self, name=None):
+        self.name = name
+        self.data = {}
+
+    def get(self, key):
+        return self.data[key]
+
+    def put(self, key, value):
+        self.data[key] = value
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def write_batch(self, puts, deletes=(), sync=False):
+        for k, v in puts:
+            self.data[k] = v
+        for k in deletes:
+            self.data.pop(k, None)
+
+    def iterate(self, prefix=''):
+        for k in sorted(self.data):
+            if k.startswith(prefix):
+                yield k, self.data[k]
+
+
+class LevelDBBackend(object):
+
+    def __init__(self, path):
+        if leveldb is None:
+            raise ImportError("the leveldb backend requires py-leveldb")
+        self.db = leveldb.LevelDB(path)
+
+    def get(self, key):
+        return self.db.Get(key)
+
+    def put(self, key, value):
+        self.db.Put(key, value)
+
+    def delete(self, key):
+        self.db.Delete(key)
+
+    def write_batch(self, puts, deletes=(), sync=False):
+        batch = leveldb.WriteBatch()
+        for k, v in puts:
+            batch.Put(k, v)
+        for k in deletes:
+            batch.Delete(k)
+        self.db.Write(batch, sync=sync)
+
+    def iterate(self, prefix=''):
+        for k, v in self.db.RangeIter(key_from=prefix or None):
+            if not k.startswith(prefix):
+                break
+            yield k, v
+
+
+class SQLiteBackend(object):
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS kv '
+                          '(key BLOB PRIMARY KEY, value BLOB NOT NULL)')
+        self.conn.commit()
+
+    def get(self, key):
+        row = self.conn.execute('SELECT value FROM kv WHERE key = ?',
+                                (buffer(key),)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return str(row[0])
+
+    def put(self, key, value):
+        self.write_batch([(key, value)])
+
+    def delete(self, key):
+        self.write_batch([], [key])
+
+    def __contains__(self, key):
+        return self.conn.execute('SELECT 1 FROM kv WHERE key = ?',
+                                 (buffer(key),)).fetchone() is not None
+
+    def write_batch(self, puts, deletes=(), sync=False):
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)',
+                ((buffer(k), buffer(v)) for k, v in puts))
+            self.conn.executemany(
+                'DELETE FROM kv WHERE key = ?',
+                ((buffer(k),) for k in deletes))
+
+    def iterate(self, prefix=''):
+        cursor = self.conn.execute(
+            'SELECT key, value FROM kv WHERE key >= ? ORDER BY key',
+            (buffer(prefix),))
+        for k, v in cursor:
+            k = str(k)
+            if not k.startswith(prefix):
+                break
+            yield k, str(v)
+
+
+backends = {
+    'memory': MemoryBackend,
+    'leveldb': LevelDBBackend,
+    'sqlite': SQLiteBackend,
+    'segments': segment.SegmentStore,
+}
+
+
+def parse_uri(dbfile):
+    ''' select a backend by uri
+
+        memory://            a new private in memory store
+        memory://name        in memory store shared by name
+        sqlite://path        SQLite database file
+        leveldb://path       LevelDB directory
+        segments://path      append only node store directory, see segment
+        path                 LevelDB directory
+
+    :return: (scheme, path), file paths are made absolute
+    '''
+    scheme, sep, path = dbfile.partition('://')
+    if not sep:
+        scheme, path = 'leveldb', dbfile
+    if scheme not in backends:
+        raise Exception("Unknown database scheme: %s" % scheme)
+    if scheme != 'memory':
+        path = os.path.abspath(path)
+    return scheme, path
+
+
+def _new_state(backend):
+    # the last item counts the writes to the backend, see `DB.get`
+    return (backend, dict(), set(), threading.Lock(),
+            cache.LRUCache(max_bytes=0), [0])
+
+
+def count_commit(puts):
+    metrics.incr('db.commits')
+    metrics.incr('db.bytes_written', sum(len(v) for _, v in puts))
+
+
 class DB(object):
 
-    def __init__(self, dbfile):
-        self.dbfile = dbfile
-        if dbfile not in databases:
-            databases[dbfile] = (
-                leveldb.LevelDB(dbfile), dict(), threading.Lock())
-        self.db, self.uncommitted, self.lock = databases[dbfile]
+    # whether tries have to pin their roots, see refcount.RefcountDB
+    pins_roots = False
+
+    def __init__(self, dbfile, cache_bytes=None):
+        '''
+        :param dbfile: uri or path of the database (see `parse_uri`), or a
+            backend object with get/put/delete/write_batch/iterate
+        :param cache_bytes: byte budget of the read cache of committed
+            values. the cache is shared by all handles on the same dbfile,
+            None keeps the current budget, 0 disables the cache
+
+        handles on the same uri share pending writes, pending deletes and
+        the read cache through `databases`. private memory stores and
+        backend objects are not registered, share the DB instance instead
+        '''
+        if not isinstance(dbfile, (str, unicode)):
+            self.dbfile = None
+            state = _new_state(dbfile)
+        else:
+            scheme, path = parse_uri(dbfile)
+            if scheme == 'memory' and not path:
+                self.dbfile = None
+                state = _new_state(MemoryBackend())
+            else:
+                self.dbfile = '%s://%s' % (scheme, path)
+                if self.dbfile not in databases:
+                    databases[self.dbfile] = _new_state(
+                        backends[scheme](path))
+                state = databases[self.dbfile]
+        (self.db, self.uncommitted, self.deletes, self.lock, self.cache,
+         self.writes) = state
+        if cache_bytes is not None:
+            with self.lock:
+                self.cache.max_bytes = cache_bytes
+                self.cache.evict()
 
     def get(self, key):
+        if metrics.ENABLED:
+            metrics.incr('db.gets')
         if key in self.uncommitted:
             return self.uncommitted[key]
-        return self.db.Get(key)
+        if key in self.deletes:
+            raise KeyError(key)
+        if not self.cache.max_bytes:
+            return self._read(key)
+        with self.lock:
+            value = self.cache.get(key)
+            writes = self.writes[0]
+        if value is not None:
+            return value
+        # the backend is read without the lock, so readers do not wait for
+        # each other
+        value = self._read(key)
+        with self.lock:
+            # a write since the read may have changed the value
+            if self.writes[0] == writes:
+                self.cache.put(key, value, len(key) + len(value))
+        return value
+
+    def _read(self, key):
+        value = self.db.get(key)
+        if metrics.ENABLED:
+            metrics.incr('db.bytes_read', len(value))
+        return value
 
     def put(self, key, value):
+        if metrics.ENABLED:
+            metrics.incr('db.puts')
         with self.lock:
             self.uncommitted[key] = value
+            self.deletes.discard(key)
 
     def commit(self):
         with self.lock:
-            batch = leveldb.WriteBatch()
-            for k, v in self.uncommitted.iteritems():
-                batch.Put(k, v)
-            self.db.Write(batch, sync=True)
+            if not self.uncommitted and not self.deletes:
+                return
+            for k in itertools.chain(self.uncommitted, self.deletes):
+                self.cache.pop(k)
+            if metrics.ENABLED:
+                count_commit(self.uncommitted.iteritems())
+            self.db.write_batch(self.uncommitted.iteritems(), self.deletes,
+                                sync=True)
+            self.writes[0] += 1
             self.uncommitted.clear()
+            self.deletes.clear()
 
     def delete(self, key):
+        ''' cancel the pending put of key, or delete the committed value if
+        no put is pending
+        '''
+        if metrics.ENABLED:
+            metrics.incr('db.deletes')
         with self.lock:
             if key in self.uncommitted:
                 del self.uncommitted[key]
-                if key not in self:
-                    self.db.Delete(key)
             else:
-                self.db.Delete(key)
+                self.cache.pop(key)
+                self.db.delete(key)
+                self.writes[0] += 1
 
-    def _has_key(self, key):
+    def delete_on_commit(self, key):
+        ''' delete key in the write batch of the next commit, a pending put
+        of key is cancelled
+        '''
+        with self.lock:
+            self.uncommitted.pop(key, None)
+            self.deletes.add(key)
+
+    def iterate(self, prefix=''):
+        ''' the committed (key, value) items of the keys starting with
+        prefix, in key order
+        '''
+        return self.db.iterate(prefix)
+
+    def _in_db(self, key):
+        ''' whether the backend has key, without reading the value if the
+        backend can tell
+        '''
+        if hasattr(self.db, '__contains__'):
+            return key in self.db
         try:
-            self.get(key)
+            self.db.get(key)
             return True
         except KeyError:
             return False
 
+    def _has_key(self, key):
+        ''' like `get`, but the value is not read when it is not cached, nor
+        put in the cache
+        '''
+        if key in self.uncommitted:
+            return True
+        if key in self.deletes:
+            return False
+        if key in self.cache:
+            return True
+        return self._in_db(key)
+
     def __contains__(self, key):
         return self._has_key(key)
 
@@ -0,0 +1,155 @@
+''' counters and timers of the database, the trie and the hashing
+
+metrics are off unless enabled, by `enable` or the TRIE_METRICS environment
+variable. the instrumented code checks ENABLED before counting, so the cost
+when off is the check
+
+usage:
+
+    metrics.enable()
+    ... trie updates ...
+    print metrics.snapshot()
+    metrics.PrometheusSink('/var/lib/node_exporter/trie.prom').emit()
+
+counters:
+
+    db.gets, db.puts, db.deletes, db.commits    database operations
+    db.bytes_read, db.bytes_written             value bytes
+    nodes.decoded, nodes.encoded                trie nodes RLP decoded and
+                                                encoded
+    sha3.calls                                  hashes computed
+
+timers, the number of calls and seconds spent in the public operations of
+the trie: get, update, delete, commit, root_hash, to_dict, get_proof. the
+time of an operation includes the operations it calls, e.g. an update
+includes its commit
+
+the counts are not locked, concurrent threads may lose increments
+'''
+import functools
+import logging
+import os
+import time
+
+ENABLED = bool(os.environ.get('TRIE_METRICS'))
+
+counters = {}
+timers = {} # name -> [calls, seconds]
+
+
+def enable(enabled=True):
+    global ENABLED
+    ENABLED = enabled
+
+
+def reset():
+    counters.clear()
+    timers.clear()
+
+
+def incr(name, value=1):
+    counters[name] = counters.get(name, 0) + value
+
+
+def add_time(name, seconds):
+    timer = timers.get(name)
+    if timer is None:
+        timer = timers[name] = [0, 0.0]
+    timer[0] += 1
+    timer[1] += seconds
+
+
+def timed(name):
+    ''' decorator timing the calls of a function under name while the
+    metrics are enabled
+    '''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                add_time(name, time.time() - start)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    ''' a copy of the metrics as a dict:
+
+        {'counters': {name: value},
+         'timers': {name: {'calls': calls, 'seconds': seconds}}}
+    '''
+    return {
+        'counters': dict(counters),
+        'timers': dict((name, {'calls': calls, 'seconds': seconds})
+                       for name, (calls, seconds) in timers.iteritems()),
+    }
+
+
+def prometheus_text(snap=None, namespace='trie'):
+    ''' the metrics in the Prometheus text exposition format. counters are
+    <namespace>_<name>_total, timers the <namespace>_op_seconds summary
+    with the name as op label
+    '''
+    if snap is None:
+        snap = snapshot()
+    lines = []
+    for name, value in sorted(snap['counters'].iteritems()):
+        metric = '%s_%s_total' % (namespace, name.replace('.', '_'))
+        lines.append('# TYPE %s counter' % metric)
+        lines.append('%s %s' % (metric, value))
+    if snap['timers']:
+        metric = '%s_op_seconds' % namespace
+        lines.append('# TYPE %s summary' % metric)
+        for name, timer in sorted(snap['timers'].iteritems()):
+            lines.append('%s_count{op="%s"} %d' % (metric, name,
+                                                  timer['calls']))
+            lines.append('%s_sum{op="%s"} %.6f' % (metric, name,
+                                                  timer['seconds']))
+    return '\n'.join(lines) + '\n'
+
+
+class DictSink(object):
+    ''' keeps the snapshot of the last emit in `data` '''
+
+    def __init__(self):
+        self.data = snapshot()
+
+    def emit(self):
+        self.data = snapshot()
+
+
+class LoggingSink(object):
+    ''' logs one line per metric '''
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger('trie.metrics')
+        self.level = level
+
+    def emit(self):
+        snap = snapshot()
+        for name, value in sorted(snap['counters'].iteritems()):
+            self.logger.log(self.level, '%s %s', name, value)
+        for name, timer in sorted(snap['timers'].iteritems()):
+            self.logger.log(self.level, '%s calls %d seconds %.6f', name,
+                            timer['calls'], timer['seconds'])
+
+
+class PrometheusSink(object):
+    ''' writes `prometheus_text` to a file, e.g. for the textfile collector
+    of the node exporter. the file is replaced in one rename
+    '''
+
+    def __init__(self, path, namespace='trie'):
+        self.path = path
+        self.namespace = namespace
+
+    def emit(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(prometheus_text(namespace=self.namespace))
+        os.rename(tmp, self.path)
@@ -0,0 +1,254 @@
+''' reference counted trie node storage with pruning
+
+every stored trie node has a count of the references to it: one for every
+stored node which has it as a sub node, and one for every pin of it as a
+root. the counts are written in the same write batch as the nodes.
+
+a trie pins its root at every commit, each commit is a generation. the pins
+of a generation are dropped `retention` generations later. nodes whose
+count drops to 0 are put on the death row of the generation and deleted by
+:meth:`RefcountDB.prune` once the generation is out of the retention window
+and the count is still 0. so the roots of the last `retention` commits, and
+all the nodes below them, stay readable.
+
+database layout, besides the nodes keyed by their 32 bytes hash:
+
+    refcount:<hash>                       the count of the node
+    deathrow:<generation><hash>           a node whose count dropped to 0
+    pins:<generation>                     RLP list of the roots pinned
+    refcount-generation                   the last generation
+'''
+import threading
+import rlp
+import db
+import metrics
+
+REFCOUNT_PREFIX = 'refcount:'
+DEATH_ROW_PREFIX = 'deathrow:'
+PINS_PREFIX = 'pins:'
+GENERATION_KEY = 'refcount-generation'
+# records the trie keeps by node hash, deleted with the node
+NODE_RECORD_PREFIXES = ['stats:'] # trie.STATS_PREFIX
+
+DEFAULT_RETENTION = 128 # generations whose roots are kept
+
+
+def node_refs(rlpnode):
+    ''' the hashes of the sub nodes referenced by an RLP encoded trie node,
+    inlined sub nodes included
+    '''
+    refs = []
+    stack = [rlp.decode(rlpnode)]
+    while stack:
+        node = stack.pop()
+        if len(node) == 17:
+            items = node[:16]
+        elif ord(node[0][0]) & 0x20:
+            # leaf, the value is not a node
+            continue
+        else:
+            items = node[1:]
+        for item in items:
+            if isinstance(item, list):
+                stack.append(item)
+            elif len(item) == 32:
+                refs.append(item)
+    return refs
+
+
+def generation_key(prefix, generation):
+    # fixed width, so the keys sort by generation
+    return '%s%020d' % (prefix, generation)
+
+
+class RefcountDB(db.DB):
+    ''' a :class:`db.DB` keeping reference counts of the trie nodes and
+    pruning the nodes no retained root references
+
+    usage:
+
+        database = RefcountDB('sqlite://state.db', retention=64)
+        trie = Trie(database, root_hash)
+        ...
+        trie.commit()
+        database.prune()    # or Pruner(database).start()
+
+    committed nodes are only deleted by `prune`, `delete` cancels a put
+    which is not committed yet
+    '''
+
+    pins_roots = True
+
+    def __init__(self, dbfile, retention=DEFAULT_RETENTION, cache_bytes=None):
+        '''
+        :param retention: number of generations of which the roots are kept
+        '''
+        super(RefcountDB, self).__init__(dbfile, cache_bytes)
+        self.retention = retention
+        self.pins = set()
+
+    def pin(self, root_hash):
+        ''' pin root_hash in the generation of the next commit
+        '''
+        self.pins.add(root_hash)
+
+    def delete(self, key):
+        with self.lock:
+            self.uncommitted.pop(key, None)
+
+    def generation(self):
+        ''' the last committed generation
+        '''
+        try:
+            return int(self.db.get(GENERATION_KEY))
+        except KeyError:
+            return 0
+
+    def _count(self, counts, key):
+        ''' the count of the node, None if it has no count record. changed
+        counts are collected in counts
+        '''
+        if key not in counts:
+            try:
+                counts[key] = int(self.db.get(REFCOUNT_PREFIX + key))
+            except KeyError:
+                counts[key] = None
+        return counts[key]
+
+    def _incref(self, counts, key):
+        counts[key] = (self._count(counts, key) or 0) + 1
+
+    def _decref(self, counts, key, death_row):
+        count = self._count(counts, key)
+        # nodes stored without counting are never pruned
+        if count is None:
+            return
+        counts[key] = count - 1
+        if not count - 1:
+            death_row.add(key)
+
+    def commit(self):
+        ''' write the pending nodes, count the references of the nodes
+        stored for the first time and of the pinned roots, and unpin the
+        roots of the generation leaving the retention window, in one write
+        batch
+        '''
+        with self.lock:
+            if not self.uncommitted and not self.deletes and not self.pins:
+                return
+            generation = self.generation() + 1
+            counts, death_row = {}, set()
+            for key, value in self.uncommitted.iteritems():
+                if len(key) != 32 or self._in_db(key):
+                    continue
+                # stored for the first time. the count may already have
+                # references of parents committed before, e.g. by an import
+                if self._count(counts, key) is None:
+                    counts[key] = 0
+                for ref in node_refs(value):
+                    self._incref(counts, ref)
+            for root_hash in self.pins:
+                self._incref(counts, root_hash)
+
+            deletes = list(self.deletes)
+            if generation > self.retention:
+                pins_key = generation_key(PINS_PREFIX,
+                                          generation - self.retention)
+                try:
+                    for root_hash in rlp.decode(self.db.get(pins_key)):
+                        self._decref(counts, root_hash, death_row)
+                    deletes.append(pins_key)
+                except KeyError:
+                    pass
+            # nodes nothing references, e.g. replaced before the commit
+            death_row.update(k for k in self.uncommitted
+                             if counts.get(k) == 0)
+
+            puts = self.uncommitted.items()
+            puts.extend((REFCOUNT_PREFIX + k, str(c))
+                        for k, c in counts.iteritems() if c is not None)
+            row = generation_key(DEATH_ROW_PREFIX, generation)
+            puts.extend((row + k, '') for k in death_row)
+            if self.pins:
+                puts.append((generation_key(PINS_PREFIX, generation),
+                             rlp.encode(list(self.pins))))
+            puts.append((GENERATION_KEY, str(generation)))
+            for k, _ in puts:
+                self.cache.pop(k)
+            for k in deletes:
+                self.cache.pop(k)
+            if metrics.ENABLED:
+                db.count_commit(puts)
+            self.db.write_batch(puts, deletes, sync=True)
+            self.writes[0] += 1
+            self.uncommitted.clear()
+            self.deletes.clear()
+            self.pins.clear()
+
+    def prune(self):
+        ''' delete the nodes on the death rows of the generations out of the
+        retention window whose count is still 0. the counts of their sub
+        nodes are decreased, sub nodes dropping to 0 are put on the death
+        row of the last generation
+
+        :return: number of deleted nodes
+        '''
+        with self.lock:
+            generation = self.generation()
+            last = generation_key(DEATH_ROW_PREFIX,
+                                  generation - self.retention + 1)
+            rows = []
+            for k, _ in self.db.iterate(DEATH_ROW_PREFIX):
+                if k >= last:
+                    break
+                rows.append(k)
+            if not rows:
+                return 0
+
+            counts, death_row, deletes = {}, set(), []
+            for row in rows:
+                key = row[len(last):]
+                deletes.append(row)
+                if self._count(counts, key) != 0:
+                    continue
+                try:
+                    value = self.db.get(key)
+                except KeyError:
+                    continue
+                deletes.extend([key, REFCOUNT_PREFIX + key])
+                deletes.extend(p + key for p in NODE_RECORD_PREFIXES)
+                counts[key] = None
+                for ref in node_refs(value):
+                    self._decref(counts, ref, death_row)
+
+            row = generation_key(DEATH_ROW_PREFIX, generation)
+            puts = [(REFCOUNT_PREFIX + k, str(c))
+                    for k, c in counts.iteritems() if c is not None]
+            puts.extend((row + k, '') for k in death_row)
+            for k in deletes:
+                self.cache.pop(k)
+            self.db.write_batch(puts, deletes, sync=True)
+            self.writes[0] += 1
+            return (len(deletes) - len(rows)) // (
+                2 + len(NODE_RECORD_PREFIXES))
+
+
+class Pruner(threading.Thread):
+    ''' background worker calling :meth:`RefcountDB.prune` every interval
+    seconds until stopped
+    '''
+
+    def __init__(self, database, interval=10.0):
+        super(Pruner, self).__init__()
+        self.daemon = True
+        self.database = database
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.database.prune()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
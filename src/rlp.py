@@ -30,6 +30,7 @@ First byte of an encoded item
     |
 0xff == 255
 '''
+import struct
 
 
 def int_to_big_endian(integer):
@@ -51,53 +52,95 @@ def big_endian_to_int(string):
     return long(s, 16)
 
 
-def __decode(s, pos=0):
-    ''' decode string start at `pos`
-    :param s: string of rlp encoded data
-    :param pos: start position of `s` to decode from
-    :return:
-        o: decoded object
-        pos: end position of the obj in the string of rlp encoded data
+def _int_at(data, start, end):
+    '''the big endian integer in data[start:end]'''
+    value = 0
+    for pos in xrange(start, end):
+        value = (value << 8) | ord(data[pos])
+    return value
+
+
+def _long_length(data, pos, length_size, end):
+    '''parse the long form length after the first byte at pos
+
+    :return: (start of the payload, length of the payload)
     '''
-    assert pos < len(s), "read beyond end of string in __decode"
+    start = pos + 1 + length_size
+    if start > end:
+        raise Exception("Length beyond the end of the data")
+    if data[pos + 1] == '\x00':
+        raise Exception("Length with leading zero bytes")
+    length = _int_at(data, pos + 1, start)
+    if length < 56:
+        raise Exception("Long form of a length below 56")
+    return start, length
 
-    fchar = ord(s[pos])
-    if fchar < 128:
-        return (s[pos], pos + 1)
-    elif fchar < 184:
-        b = fchar - 128
-        return (s[pos + 1:pos + 1 + b], pos + 1 + b)
-    elif fchar < 192:
-        b = fchar - 183
-        b2 = big_endian_to_int(s[pos + 1:pos + 1 + b])
-        return (s[pos + 1 + b:pos + 1 + b + b2], pos + 1 + b + b2)
-    elif fchar < 248:
-        o = []
-        pos += 1
-        pos_end = pos + fchar - 192
-
-        while pos < pos_end:
-            obj, pos = __decode(s, pos)
-            o.append(obj)
-        assert pos == pos_end, "read beyond list boundary in __decode"
-        return (o, pos)
-    else:
-        b = fchar - 247
-        b2 = big_endian_to_int(s[pos + 1:pos + 1 + b])
-        o = []
-        pos += 1 + b
-        pos_end = pos + b2
-        while pos < pos_end:
-            obj, pos = __decode(s, pos)
-            o.append(obj)
-        assert pos == pos_end, "read beyond list boundary in __decode"
-        return (o, pos)
+
+def _decode(data):
+    ''' decode without recursion: a stack holds the open lists with their
+    end positions. strings are slices of data, so they are views of a
+    memoryview, not copies
+
+    :param data: str, buffer or memoryview
+    :raises: Exception if data is not exactly one canonical RLP item
+    '''
+    size = len(data)
+    top = []
+    items, end = top, size
+    stack = []
+    pos = 0
+    while True:
+        if pos == end:
+            if not stack:
+                break
+            items, end = stack.pop()
+            continue
+        if items is top and top:
+            raise Exception("Trailing bytes after the RLP item")
+
+        fchar = ord(data[pos])
+        if fchar < 0x80:
+            items.append(data[pos:pos + 1])
+            pos += 1
+            continue
+        elif fchar < 0xb8:
+            start, length = pos + 1, fchar - 0x80
+            if length == 1 and start < end and data[start] < '\x80':
+                raise Exception("Single byte below 0x80 with a length")
+        elif fchar < 0xc0:
+            start, length = _long_length(data, pos, fchar - 0xb7, end)
+        elif fchar < 0xf8:
+            start, length = pos + 1, fchar - 0xc0
+        else:
+            start, length = _long_length(data, pos, fchar - 0xf7, end)
+
+        item_end = start + length
+        if item_end > end:
+            raise Exception("RLP item beyond the end of its list or data")
+        if fchar < 0xc0:
+            items.append(data[start:item_end])
+            pos = item_end
+        else:
+            sub_items = []
+            items.append(sub_items)
+            stack.append((items, end))
+            items, end = sub_items, item_end
+            pos = start
+    return top[0]
 
 
 def decode(s):
     assert isinstance(s, str)
     if s:
-        return __decode(s)[0]
+        return _decode(s)
+
+
+def decode_view(data):
+    '''decode a str, buffer or memoryview, the strings of the result are
+    memoryview slices of data instead of copies'''
+    data = memoryview(data)
+    if len(data):
+        return _decode(data)
 
 
 def into(data, pos):
@@ -126,8 +169,7 @@ def next_item_pos(data, pos):
         return pos + 1 + (fchar % 64)
     else:
         b = (fchar % 64) - 55
-        b2 = big_endian_to_int(data[pos + 1:pos + 1 + b])
-        return pos + 1 + b + b2
+        return pos + 1 + b + _int_at(data, pos + 1, pos + 1 + b)
 
 
 def descend(data, *indices):
@@ -142,27 +184,205 @@ def descend(data, *indices):
     return data[pos: finish_pos]
 
 
+class RLPView(object):
+    ''' a lazy view of an encoded list. item i is found by skipping the
+    items before it with `next_item_pos`, nothing is decoded but the item
+    read. strings are returned as str, lists as views
+
+    >>> view = RLPView(encode(['cat', ['dog'], 'a']))
+    >>> view[2], view[1][0], len(view)
+    ('a', 'dog', 3)
+
+    the data is not validated, see `decode` for that
+    '''
+
+    __slots__ = ('data', 'start', 'end', 'offsets')
+
+    def __init__(self, data, pos=0):
+        '''
+        :param data: str with the encoded list at pos
+        '''
+        self.data = data
+        self.start = into(data, pos)
+        self.end = next_item_pos(data, pos)
+        # positions of the items, once `index` is called
+        self.offsets = None
+
+    def index(self):
+        '''build the table of the item positions once, for views which are
+        read many times'''
+        if self.offsets is None:
+            offsets = []
+            pos = self.start
+            while pos < self.end:
+                offsets.append(pos)
+                pos = next_item_pos(self.data, pos)
+            self.offsets = offsets
+        return self
+
+    def len_at_most(self, limit):
+        '''the number of items, counting no further than limit'''
+        if self.offsets is not None:
+            return min(len(self.offsets), limit)
+        data, pos, end = self.data, self.start, self.end
+        count = 0
+        while pos < end and count < limit:
+            pos = next_item_pos(data, pos)
+            count += 1
+        return count
+
+    def item_pos(self, i):
+        '''position of the header of item i'''
+        if self.offsets is not None or i < 0:
+            return self.index().offsets[i]
+        data, pos, end = self.data, self.start, self.end
+        for _ in xrange(i):
+            pos = next_item_pos(data, pos)
+            if pos >= end:
+                break
+        if pos >= end:
+            raise IndexError("RLP list index out of range")
+        return pos
+
+    def raw(self, i):
+        '''the encoding of item i'''
+        pos = self.item_pos(i)
+        return self.data[pos:next_item_pos(self.data, pos)]
+
+    def __getitem__(self, i):
+        data = self.data
+        pos = self.item_pos(i)
+        fchar = ord(data[pos])
+        if fchar < 0x80:
+            return data[pos]
+        if fchar >= 0xc0:
+            return RLPView(data, pos)
+        if fchar < 0xb8:
+            return data[pos + 1:pos + 1 + fchar - 0x80]
+        return data[pos + 1 + fchar - 0xb7:next_item_pos(data, pos)]
+
+    def __len__(self):
+        return len(self.index().offsets)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+
 def encode_length(L, offset):
     if L < 56:
         return chr(L + offset)
     elif L < 256 ** 8:
-        BL = int_to_big_endian(L)
+        BL = struct.pack('>Q', L).lstrip('\x00')
         return chr(len(BL) + offset + 55) + BL
     else:
         raise Exception("input too long")
 
 
+def _str_header(item):
+    '''header of a str item, empty for a single byte below 0x80'''
+    size = len(item)
+    if size < 56:
+        if size == 1 and item < '\x80':
+            return ''
+        return chr(128 + size)
+    return encode_length(size, 128)
+
+
+def _list_size(items, sizes):
+    '''payload size of a list. the payload sizes of the list and its sub
+    lists are appended to sizes in the order they are written'''
+    index = len(sizes)
+    sizes.append(0)
+    length = 0
+    for item in items:
+        if item.__class__ is not str:
+            if isinstance(item, list):
+                size = _list_size(item, sizes)
+                length += len(encode_length(size, 192)) + size
+                continue
+            if not isinstance(item, unicode):
+                raise TypeError("Encoding of %s not supported" % type(item))
+            item = str(item)
+        length += len(_str_header(item)) + len(item)
+    sizes[index] = length
+    return length
+
+
+def _write_list(parts, items, sizes):
+    '''append the parts of a list with the payload sizes of `_list_size`
+
+    :param sizes: iterator over the sizes
+    '''
+    parts.append(encode_length(next(sizes), 192))
+    for item in items:
+        if item.__class__ is not str:
+            if isinstance(item, list):
+                _write_list(parts, item, sizes)
+                continue
+            item = str(item)
+        parts.append(_str_header(item))
+        parts.append(item)
+
+
+def _encode_flat(items):
+    '''encode a list of str items and lists, e.g. a branch node. None if
+    an item is neither
+
+    the lists are encoded on their own and copied once more, which costs
+    less than the sizing pass for the inlined sub nodes of trie nodes,
+    which are below 32 bytes
+    '''
+    parts = [None]
+    length = 0
+    for item in items:
+        if item.__class__ is str:
+            header = _str_header(item)
+        elif isinstance(item, list):
+            header, item = '', encode(item)
+        else:
+            return None
+        parts.append(header)
+        parts.append(item)
+        length += len(header) + len(item)
+    parts[0] = encode_length(length, 192)
+    return ''.join(parts)
+
+
+def _encode_pair(first, second):
+    '''encode a list of two str items, e.g. a leaf or extension node'''
+    first_header = _str_header(first)
+    second_header = _str_header(second)
+    length = (len(first_header) + len(first) +
+              len(second_header) + len(second))
+    return ''.join((encode_length(length, 192),
+                    first_header, first, second_header, second))
+
+
 def encode(s):
+    '''encode with one copy of every item: a first pass computes the size
+    of every list, so the headers are known before the payloads, a second
+    one collects the headers and items which are joined into the result'''
     if isinstance(s, (str, unicode)):
         s = str(s)
         if len(s) == 1 and ord(s) < 128:
             return s
         else:
             return encode_length(len(s), 128) + s
-    elif isinstance(s, list):
-        return concat(map(encode, s))
-
-    raise TypeError("Encoding of %s not supported" % type(s))
+    if not isinstance(s, list):
+        raise TypeError("Encoding of %s not supported" % type(s))
+    # fast paths of trie nodes: leaf and extension nodes, then branch
+    # nodes and nodes with inlined sub nodes
+    if len(s) == 2 and s[0].__class__ is str and s[1].__class__ is str:
+        return _encode_pair(s[0], s[1])
+    if len(s) in (2, 17):
+        encoded = _encode_flat(s)
+        if encoded is not None:
+            return encoded
+    sizes, parts = [], []
+    _list_size(s, sizes)
+    _write_list(parts, s, iter(sizes))
+    return ''.join(parts)
 
 
 def concat(s):
@@ -0,0 +1,213 @@
+''' append only node store
+
+Trie nodes are immutable and addressed by their hash, so they are appended
+to segment files and never rewritten. Reads copy the value out of an mmap
+of the segment files.
+
+directory layout:
+
+    segment.000000, segment.000001, ...
+        records of [key length: 1 byte][value length: 4 bytes][key][value]
+        a value length of TOMBSTONE marks a deleted key, without a value
+
+    index
+        records of [key length: 1 byte][segment: 4 bytes][value offset: 8
+        bytes][value length: 4 bytes][key], appended after every write
+        batch so the hash -> location map is loaded without reading the
+        segments when reopened. records of segments written after the last
+        index record (e.g. after a crash) are recovered from the segments.
+'''
+import os
+import bisect
+import mmap
+import struct
+
+SEGMENT_SIZE = 256 * 1024 * 1024
+TOMBSTONE = 0xffffffff
+# keys are kept in buckets by their first bytes for `iterate`, so a prefix
+# scan only sorts the keys of its bucket
+BUCKET_PREFIX = 2
+
+RECORD = struct.Struct('>BI')
+INDEX_RECORD = struct.Struct('>BIQI')
+
+
+class SegmentStore(object):
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE):
+        '''
+        :param path: directory of the store, created if missing
+        :param segment_size: start a new segment file once the current one
+            grows beyond this size
+        '''
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.segment_size = segment_size
+        self.locations = {}
+        # key[:BUCKET_PREFIX] -> set of the keys, and the sorted keys of the
+        # buckets unchanged since they were last sorted
+        self.buckets = {}
+        self.sorted_buckets = {}
+        self.maps = {}
+        self.segment, self.end = 0, 0
+        self._load_index()
+        self._recover()
+        self.data_file = open(self._segment_path(self.segment), 'ab')
+        self.index_file = open(os.path.join(path, 'index'), 'ab')
+
+    def _segment_path(self, segment):
+        return os.path.join(self.path, 'segment.%06d' % segment)
+
+    def _apply(self, key, segment, offset, length):
+        name = key[:BUCKET_PREFIX]
+        if length == TOMBSTONE:
+            if self.locations.pop(key, None) is not None:
+                bucket = self.buckets[name]
+                bucket.discard(key)
+                if not bucket:
+                    del self.buckets[name]
+                self.sorted_buckets.pop(name, None)
+            end = offset
+        else:
+            if key not in self.locations:
+                self.buckets.setdefault(name, set()).add(key)
+                self.sorted_buckets.pop(name, None)
+            self.locations[key] = (segment, offset, length)
+            end = offset + length
+        if (segment, end) > (self.segment, self.end):
+            self.segment, self.end = segment, end
+
+    def _load_index(self):
+        index_path = os.path.join(self.path, 'index')
+        if not os.path.exists(index_path):
+            return
+        with open(index_path, 'rb') as f:
+            data = f.read()
+        pos = 0
+        while pos + INDEX_RECORD.size <= len(data):
+            klen, segment, offset, length = INDEX_RECORD.unpack_from(
+                data, pos)
+            if pos + INDEX_RECORD.size + klen > len(data):
+                break
+            pos += INDEX_RECORD.size
+            self._apply(data[pos:pos + klen], segment, offset, length)
+            pos += klen
+        if pos < len(data):
+            # drop a partially written record
+            with open(index_path, 'r+b') as f:
+                f.truncate(pos)
+
+    def _recover(self):
+        ''' index the records appended after the last index record
+        '''
+        recovered = []
+        segment, start = self.segment, self.end
+        while os.path.exists(self._segment_path(segment)):
+            with open(self._segment_path(segment), 'rb') as f:
+                f.seek(start)
+                data = f.read()
+            pos = 0
+            while pos + RECORD.size <= len(data):
+                klen, length = RECORD.unpack_from(data, pos)
+                vlen = 0 if length == TOMBSTONE else length
+                if pos + RECORD.size + klen + vlen > len(data):
+                    break
+                key = data[pos + RECORD.size:pos + RECORD.size + klen]
+                offset = start + pos + RECORD.size + klen
+                recovered.append((key, segment, offset, length))
+                pos += RECORD.size + klen + vlen
+            if pos < len(data):
+                # drop a partially written record
+                with open(self._segment_path(segment), 'r+b') as f:
+                    f.truncate(start + pos)
+            segment, start = segment + 1, 0
+        for record in recovered:
+            self._apply(*record)
+        if recovered:
+            with open(os.path.join(self.path, 'index'), 'ab') as f:
+                f.write(''.join(self._index_record(*r) for r in recovered))
+
+    def _index_record(self, key, segment, offset, length):
+        return INDEX_RECORD.pack(len(key), segment, offset, length) + key
+
+    def _map(self, segment, end):
+        mm = self.maps.get(segment)
+        if mm is None or len(mm) < end:
+            with open(self._segment_path(segment), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = mm
+        return mm
+
+    def get(self, key):
+        segment, offset, length = self.locations[key]
+        return self._map(segment, offset + length)[offset:offset + length]
+
+    def __contains__(self, key):
+        return key in self.locations
+
+    def put(self, key, value):
+        self.write_batch([(key, value)])
+
+    def delete(self, key):
+        self.write_batch([], [key])
+
+    def write_batch(self, puts, deletes=(), sync=False):
+        if self.end >= self.segment_size:
+            self.data_file.close()
+            self.segment, self.end = self.segment + 1, 0
+            self.data_file = open(self._segment_path(self.segment), 'ab')
+        records, index, pos = [], [], self.end
+        written = set()
+        for k, v in puts:
+            records.append(RECORD.pack(len(k), len(v)) + k + v)
+            index.append((k, self.segment, pos + RECORD.size + len(k),
+                          len(v)))
+            pos += RECORD.size + len(k) + len(v)
+            written.add(k)
+        for k in deletes:
+            # no tombstones for keys that were never stored
+            if k not in self.locations and k not in written:
+                continue
+            records.append(RECORD.pack(len(k), TOMBSTONE) + k)
+            index.append((k, self.segment, pos + RECORD.size + len(k),
+                          TOMBSTONE))
+            pos += RECORD.size + len(k)
+        if not records:
+            return
+        self.data_file.write(''.join(records))
+        self.data_file.flush()
+        self.index_file.write(''.join(self._index_record(*r) for r in index))
+        self.index_file.flush()
+        if sync:
+            os.fsync(self.data_file.fileno())
+            os.fsync(self.index_file.fileno())
+        for record in index:
+            self._apply(*record)
+
+    def iterate(self, prefix=''):
+        head = prefix[:BUCKET_PREFIX]
+        if len(head) == BUCKET_PREFIX:
+            names = [head] if head in self.buckets else []
+        else:
+            names = sorted(name for name in self.buckets
+                           if name.startswith(head))
+        for name in names:
+            keys = self._sorted_bucket(name)
+            for i in xrange(bisect.bisect_left(keys, prefix), len(keys)):
+                if not keys[i].startswith(prefix):
+                    break
+                yield keys[i], self.get(keys[i])
+
+    def _sorted_bucket(self, name):
+        keys = self.sorted_buckets.get(name)
+        if keys is None:
+            keys = self.sorted_buckets[name] = sorted(self.buckets[name])
+        return keys
+
+    def close(self):
+        self.data_file.close()
+        self.index_file.close()
+        for mm in self.maps.values():
+            mm.close()
+        self.maps.clear()
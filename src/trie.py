@@ -1,14 +1,32 @@
 #!/usr/bin/env python
 
-import os
+import contextlib
+import itertools
+import multiprocessing
+import struct
 import rlp
 import utils
 import db
+import refcount
+import cache
+import metrics
 
 DB = db.DB
 
 PRINT = 0 #change to 1 to turn on printing
 
+NODE_CACHE_SIZE = 4096 # default number of decoded nodes cached per trie
+GET_CACHED_LEVELS = 3 # levels below the root a get decodes into the cache
+
+# flat index of the values by key, the keys are hex encoded
+FLAT_INDEX_PREFIX = 'flat:'
+FLAT_INDEX_ROOT_KEY = 'flat-root' # root hash the flat index is of
+STATS_PREFIX = 'stats:' # the items and STATS_FIELDS of a root, by root hash
+
+HEX_NIBBLES = '0123456789abcdef'
+NIBBLE_VALUES = dict((c, i) for i, c in enumerate(HEX_NIBBLES))
+
+
 def bin_to_nibbles(s):
     """convert string s to nibbles (half-bytes)
 
@@ -21,10 +39,7 @@ def bin_to_nibbles(s):
     >>> bin_to_nibbles("hello")
     [6, 8, 6, 5, 6, 12, 6, 12, 6, 15]
     """
-    res = []
-    for x in s:
-        res += divmod(ord(x), 16)
-    return res
+    return [NIBBLE_VALUES[c] for c in s.encode('hex')]
 
 
 def nibbles_to_bin(nibbles):
@@ -76,16 +91,20 @@ def pack_nibbles(nibbles):
     else:
         flags = 0
 
+    return pack_hex(''.join(HEX_NIBBLES[x] for x in nibbles), flags)
+
+
+def pack_hex(nibbles, flags=0):
+    """pack nibbles given as a hex string to binary
+
+    :param nibbles: hex string, one char per nibble, without terminator
+    :param flags: 2 if the nibbles have a terminator, otherwise 0
+    """
     oddlen = len(nibbles) % 2
     flags |= oddlen   # set lowest bit if odd number of nibbles
     if oddlen:
-        nibbles = [flags] + nibbles
-    else:
-        nibbles = [flags, 0] + nibbles
-    o = ''
-    for i in range(0, len(nibbles), 2):
-        o += chr(16 * nibbles[i] + nibbles[i + 1])
-    return o
+        return (HEX_NIBBLES[flags] + nibbles).decode('hex')
+    return (HEX_NIBBLES[flags] + '0' + nibbles).decode('hex')
 
 
 def unpack_to_nibbles(bindata):
@@ -94,17 +113,24 @@ def unpack_to_nibbles(bindata):
     :param bindata: binary packed from nibbles
     :return: nibbles sequence, may have a terminator
     """
-    o = bin_to_nibbles(bindata)
-    flags = o[0]
-    if flags & 2:
+    nibbles, has_terminator = unpack_to_hex(bindata)
+    o = [NIBBLE_VALUES[c] for c in nibbles]
+    if has_terminator:
         o.append(NIBBLE_TERMINATOR)
-    if flags & 1 == 1:
-        o = o[1:]
-    else:
-        o = o[2:]
     return o
 
 
+def unpack_to_hex(bindata):
+    """unpack packed binary data to a hex string, one char per nibble
+
+    :param bindata: binary packed from nibbles
+    :return: (hex string without terminator, has terminator)
+    """
+    o = bindata.encode('hex')
+    flags = NIBBLE_VALUES[o[0]]
+    return o[2 - (flags & 1):], bool(flags & 2)
+
+
 def starts_with(full, part):
     ''' test whether the items in the part is
     the leading items of the full
@@ -114,6 +140,93 @@ def starts_with(full, part):
     return full[:len(part)] == part
 
 
+class NibblePath(object):
+    ''' a view of the nibbles [start, end) of a hex string, one char per
+    nibble. slicing only moves the offsets, and comparing and packing work
+    on the hex string, so walking down a key does not copy it
+
+    >>> path = NibblePath.from_bin("he")
+    >>> path[1], len(path[1:]), path[1:].tolist()
+    (8, 3, [8, 6, 5])
+    >>> path[1:].pack(terminator=True).encode('hex')
+    '3865'
+    '''
+
+    __slots__ = ('hex', 'start', 'end')
+
+    def __init__(self, hex, start=0, end=None):
+        self.hex = hex
+        self.start = start
+        self.end = len(hex) if end is None else end
+
+    @classmethod
+    def from_bin(cls, s):
+        return cls(s.encode('hex'))
+
+    @classmethod
+    def from_packed(cls, bindata):
+        '''
+        :param bindata: binary packed from nibbles
+        :return: (path without terminator, has terminator)
+        '''
+        nibbles, has_terminator = unpack_to_hex(bindata)
+        return cls(nibbles), has_terminator
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __nonzero__(self):
+        return self.end > self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, _ = i.indices(self.end - self.start)
+            return NibblePath(self.hex, self.start + start,
+                              self.start + max(start, stop))
+        if i < 0:
+            i += self.end - self.start
+        if not 0 <= i < self.end - self.start:
+            raise IndexError("nibble index out of range")
+        return NIBBLE_VALUES[self.hex[self.start + i]]
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __eq__(self, other):
+        if isinstance(other, NibblePath):
+            return len(self) == len(other) and \
+                self.hex.startswith(other.tohex(), self.start)
+        return self.tolist() == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'NibblePath(%r)' % self.tolist()
+
+    def tohex(self):
+        return self.hex[self.start:self.end]
+
+    def tolist(self):
+        return [NIBBLE_VALUES[c] for c in self.hex[self.start:self.end]]
+
+    def startswith(self, prefix):
+        return len(prefix) <= len(self) and \
+            self.hex.startswith(prefix.tohex(), self.start)
+
+    def common_prefix_length(self, other):
+        a, i = self.hex, self.start
+        b, j = other.hex, other.start
+        length = min(self.end - i, other.end - j)
+        n = 0
+        while n < length and a[i + n] == b[j + n]:
+            n += 1
+        return n
+
+    def pack(self, terminator=False):
+        return pack_hex(self.tohex(), 2 if terminator else 0)
+
+
 (
     NODE_TYPE_BLANK,
     NODE_TYPE_LEAF,
@@ -129,17 +242,394 @@ def is_key_value_type(node_type):
 BLANK_NODE = ''
 BLANK_ROOT = ''
 
+# node counts of Trie.stats, the node types are the indexes of their counts
+STATS_FIELDS = ('stored_nodes', 'leaf_nodes', 'extension_nodes',
+                'branch_nodes', 'stored_bytes')
+
+IMPORT_BATCH_SIZE = 10000 # nodes per write batch of Trie.import_
+PROGRESS_INTERVAL = 10000 # nodes between progress calls of export/import_
+
+
+class Node(list):
+    ''' a trie node, the items are those of the node in form of list. the
+    RLP encoding and the hash of the node are computed once and cached,
+    changing an item drops them
+
+    .. note::
+
+        inlined sub nodes are items of the node, a sub node changed in place
+        has to be assigned to its slot again
+    '''
+
+    __slots__ = ('_rlp', '_hash', 'dirty')
+
+    node_type = None
+
+    def __init__(self, items, rlpnode=None, hashkey=None):
+        list.__init__(self, items)
+        self._rlp = rlpnode
+        self._hash = hashkey
+        self.dirty = False
+
+    def __setitem__(self, index, value):
+        list.__setitem__(self, index, value)
+        self._rlp = self._hash = None
+
+    @property
+    def rlp(self):
+        if self._rlp is None:
+            if metrics.ENABLED:
+                metrics.incr('nodes.encoded')
+            self._rlp = rlp.encode(self)
+        return self._rlp
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            self._hash = utils.sha3(self.rlp)
+        return self._hash
+
+    def copy(self, deep=True):
+        ''' copy the node with its cached encoding, hash and dirty flag
+
+        :param deep: also copy the inlined sub nodes, so the copy can be
+            changed in place without touching the original
+        '''
+        items = self
+        if deep:
+            items = [x.copy() if isinstance(x, Node) else x for x in self]
+        node = self.__class__(items, self._rlp, self._hash)
+        node.dirty = self.dirty
+        return node
+
+
+class KVNode(Node):
+    ''' [packed key, value or sub node], the key is unpacked once
+    '''
+
+    __slots__ = ('_path',)
+
+    def __init__(self, items, rlpnode=None, hashkey=None):
+        Node.__init__(self, items, rlpnode, hashkey)
+        self._path = None
+
+    def __setitem__(self, index, value):
+        Node.__setitem__(self, index, value)
+        if index == 0:
+            self._path = None
+
+    def copy(self, deep=True):
+        node = Node.copy(self, deep)
+        node._path = self._path
+        return node
+
+    @property
+    def path(self):
+        ''' the key as a NibblePath without terminator '''
+        if self._path is None:
+            self._path = NibblePath(unpack_to_hex(self[0])[0])
+        return self._path
+
+
+class LeafNode(KVNode):
+    __slots__ = ()
+    node_type = NODE_TYPE_LEAF
+
+
+class ExtensionNode(KVNode):
+    __slots__ = ()
+    node_type = NODE_TYPE_EXTENSION
+
+
+class BranchNode(Node):
+    __slots__ = ()
+    node_type = NODE_TYPE_BRANCH
+
+
+def kv_node(packed_key, value):
+    ''' a LeafNode or an ExtensionNode, by the terminator flag of the key
+    '''
+    if ord(packed_key[0]) & 0x20:
+        return LeafNode([packed_key, value])
+    return ExtensionNode([packed_key, value])
+
+
+def to_node(items, rlpnode=None, hashkey=None):
+    ''' build the typed node of a node in form of list, e.g. as decoded
+    from RLP, including its inlined sub nodes
+
+    :param rlpnode: the RLP encoding of the node, if known
+    :param hashkey: the hash of the node, if known
+    '''
+    if len(items) == 17:
+        node = BranchNode([to_node(x) if isinstance(x, list) else x
+                           for x in items], rlpnode, hashkey)
+    elif ord(items[0][0]) & 0x20:
+        node = LeafNode(items, rlpnode, hashkey)
+    else:
+        node = ExtensionNode(
+            [items[0], to_node(items[1]) if isinstance(items[1], list)
+             else items[1]], rlpnode, hashkey)
+    return node
+
+
+def _walk(node, nibbles, load_node):
+    ''' follow the path of a key down from node
+
+    :param node: node in form of list, :class:`rlp.RLPView` of a stored
+        node, or BLANK_NODE
+    :param nibbles: hex string of the key
+    :param load_node: function returning the node of an encoded node
+    :return: the value, BLANK_NODE if the key does not exist
+    '''
+    pos, end = 0, len(nibbles)
+    while True:
+        if node == BLANK_NODE:
+            return BLANK_NODE
+        if isinstance(node, rlp.RLPView):
+            # read without decoding, see `Trie._peek_node`
+            if node.len_at_most(3) == 3:
+                node_type = NODE_TYPE_BRANCH
+            else:
+                curr_key, is_leaf = unpack_to_hex(node[0])
+                node_type = NODE_TYPE_LEAF if is_leaf else NODE_TYPE_EXTENSION
+        else:
+            node_type = node.node_type
+            if node_type != NODE_TYPE_BRANCH:
+                curr_key = node.path.hex
+
+        if node_type == NODE_TYPE_BRANCH:
+            # already reach the expected node
+            if pos == end:
+                return node[16]
+            node = load_node(node[NIBBLE_VALUES[nibbles[pos]]])
+            pos += 1
+            continue
+
+        # key value node
+        if node_type == NODE_TYPE_LEAF:
+            if end - pos == len(curr_key) and \
+                    nibbles.startswith(curr_key, pos):
+                return node[1]
+            return BLANK_NODE
+
+        # traverse child nodes of the extension node
+        if end - pos < len(curr_key) or \
+                not nibbles.startswith(curr_key, pos):
+            return BLANK_NODE
+        node = load_node(node[1])
+        pos += len(curr_key)
+
+
+def verify_proof(root_hash, key, proof):
+    ''' check a proof made by :meth:`Trie.get_proof`, without a database
+
+    :return: the value of key, BLANK_NODE if the proof shows that key does
+        not exist
+    :raises: Exception if the proof lacks a node of the path of key
+    '''
+    return verify_multi_proof(root_hash, [key], proof)[key]
+
+
+def verify_multi_proof(root_hash, keys, proof):
+    ''' check a proof made by :meth:`Trie.get_multi_proof`, without a
+    database. every node of the proof is hashed and decoded once
+
+    :return: dict of the value of each key, BLANK_NODE for the keys the
+        proof shows do not exist
+    :raises: Exception if the proof lacks a node of the path of a key
+    '''
+    encoded_nodes = dict((utils.sha3(rlpnode), rlpnode) for rlpnode in proof)
+    nodes = {}
+
+    def load_node(encoded):
+        if encoded == BLANK_NODE or isinstance(encoded, list):
+            return encoded
+        node = nodes.get(encoded)
+        if node is None:
+            if encoded not in encoded_nodes:
+                raise Exception("Proof lacks node %s" % encoded.encode('hex'))
+            rlpnode = encoded_nodes[encoded]
+            node = nodes[encoded] = to_node(rlp.decode(rlpnode), rlpnode,
+                                            encoded)
+        return node
+
+    root_node = load_node(root_hash)
+    return dict((key, _walk(root_node, str(key).encode('hex'), load_node))
+                for key in keys)
+
+
+def _add_node_counts(counts, node, sign):
+    ''' add (sign 1) or remove (sign -1) a node stored by hash and its
+    inlined sub nodes to counts of STATS_FIELDS
+    '''
+    rlpnode = node.rlp
+    counts[0] += sign
+    counts[4] += sign * len(rlpnode)
+    if node.node_type == NODE_TYPE_LEAF or \
+            not any(isinstance(x, Node) for x in node):
+        counts[node.node_type] += sign
+        return
+    # inlined sub nodes may have been changed in place since the node was
+    # encoded, the encoding has the sub nodes of the node
+    stack = [to_node(rlp.decode(rlpnode))]
+    while stack:
+        node = stack.pop()
+        counts[node.node_type] += sign
+        if node.node_type != NODE_TYPE_LEAF:
+            stack.extend(x for x in node if isinstance(x, Node))
+
+
+def _diff_items(old_items, new_items):
+    ''' merge two streams of (key, value) items in key order
+
+    :return: iterator over the (key, old value, new value) of the keys
+        whose values differ, BLANK_NODE for missing values
+    '''
+    old, new = next(old_items, None), next(new_items, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield old[0], old[1], BLANK_NODE
+            old = next(old_items, None)
+        elif old is None or new[0] < old[0]:
+            yield new[0], BLANK_NODE, new[1]
+            new = next(new_items, None)
+        else:
+            if old[1] != new[1]:
+                yield old[0], old[1], new[1]
+            old, new = next(old_items, None), next(new_items, None)
+
+
+def _write_record(fileobj, data):
+    ''' write data with a 4 byte big endian length in front
+
+    :return: number of bytes written
+    '''
+    fileobj.write(struct.pack('>I', len(data)))
+    fileobj.write(data)
+    return 4 + len(data)
+
+
+def _read_record(fileobj):
+    ''' read a record written by `_write_record`, None at the end of file
+    '''
+    header = fileobj.read(4)
+    if not header:
+        return None
+    if len(header) < 4:
+        raise Exception("Truncated record length")
+    length, = struct.unpack('>I', header)
+    data = fileobj.read(length)
+    if len(data) < length:
+        raise Exception("Truncated record, %d of %d bytes"
+                        % (len(data), length))
+    return data
+
+
+class Cursor(object):
+    ''' a range scan over the items of a root, which can be stopped,
+    serialized and resumed later, e.g. to serve pages of the items
+
+    usage:
+
+        cursor = trie.cursor(start, end)
+        page = cursor.fetch(100)
+        data = cursor.serialize()
+        ...
+        cursor = Cursor.deserialize(trie, data)
+        next_page = cursor.fetch(100)
+
+    the cursor reads the root it was created for, so the pages stay
+    consistent while the trie changes, as long as the nodes of the root are
+    kept in the database
+    '''
+
+    def __init__(self, trie, root_hash, start='', end=None):
+        '''
+        :param trie: the :class:`Trie` to read the nodes through
+        :param start: the next key to read from
+        :param end: the key after the range, None for no upper limit
+        '''
+        self.trie = trie
+        self.root_hash = root_hash
+        self.start = start
+        self.end = end
+        self._items = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._items is None:
+            self._items = self.trie._iter_items(
+                self.trie._load_node(self.root_hash),
+                self.start.encode('hex'),
+                None if self.end is None else self.end.encode('hex'))
+        key, value = next(self._items)
+        # the smallest key after key
+        self.start = key + '\x00'
+        return key, value
+
+    def fetch(self, count):
+        ''' read up to count items, fewer at the end of the range
+        '''
+        items = []
+        while len(items) < count:
+            try:
+                items.append(self.next())
+            except StopIteration:
+                break
+        return items
+
+    def serialize(self):
+        return rlp.encode([self.root_hash, self.start,
+                           [] if self.end is None else self.end])
+
+    @classmethod
+    def deserialize(cls, trie, data):
+        root_hash, start, end = rlp.decode(data)
+        return cls(trie, root_hash, start, None if end == [] else end)
+
 
 class Trie(object):
 
-    def __init__(self, dbfile, root_hash=BLANK_ROOT):
+    def __init__(self, dbfile, root_hash=BLANK_ROOT, defer_hashing=False,
+                 node_cache=None, flat_index=False):
         '''it also present a dictionary like interface
 
-        :param dbfile: key value database
+        :param dbfile: key value database, a :class:`db.DB`, a backend
+            object or a uri/path as accepted by :func:`db.parse_uri`
         :root: blank or trie node in form of [key, value] or [v0,v1..v15,v]
+        :param defer_hashing: keep modified nodes in memory as dirty nodes
+            and only hash and store them when the root hash is requested
+            or the trie is committed. updates and deletes are then never
+            written to the database until :meth:`commit`
+        :param node_cache: a :class:`cache.LRUCache` of decoded nodes keyed
+            by node hash, may be shared by tries on the same database.
+            defaults to a cache of `NODE_CACHE_SIZE` nodes
+        :param flat_index: maintain a flat index of the values by key in the
+            database, written in the same commit as the nodes, and serve
+            `get` from it. the index is of one root, it is only used and
+            maintained while the trie is at that root, see
+            :meth:`rebuild_flat_index`. only one trie per database can
+            have a flat index
         '''
-        dbfile = os.path.abspath(dbfile)
-        self.db = DB(dbfile)
+        self.db = dbfile if isinstance(dbfile, DB) else DB(dbfile)
+        if node_cache is None:
+            node_cache = cache.LRUCache(max_entries=NODE_CACHE_SIZE)
+        self.node_cache = node_cache
+        self.defer_hashing = defer_hashing
+        self.flat_index = flat_index
+        self._batch_depth = 0
+        # key -> value of the writes of the trie since the last commit. they
+        # are kept by the trie, not by the database, which other tries may
+        # share, and written by `commit`
+        self._uncommitted = {}
+        # keys the trie deletes with its next commit
+        self._deletes = set()
+        # hash -> number of stores of the node since the last commit, the
+        # same node can be stored at several places of the trie
+        self._pending_stores = {}
         self.set_root_hash(root_hash)
 
     @property
@@ -148,13 +638,16 @@ class Trie(object):
         '''
         return self.get_root_hash()
 
+    @metrics.timed('root_hash')
     def get_root_hash(self):
         if self.root_node == BLANK_NODE:
             return BLANK_ROOT
         assert isinstance(self.root_node, list)
-        val = rlp.encode(self.root_node)
-        key = utils.sha3(val)
-        self.db.put(key, val)
+        if self.root_node.dirty:
+            self._hash_dirty_nodes(self.root_node)
+        # the encoding and hash are cached by the root node until it changes
+        key = self.root_node.hash
+        self._uncommitted[key] = self.root_node.rlp
         return key
 
     @root_hash.setter
@@ -162,49 +655,245 @@ class Trie(object):
         self.set_root_hash(value)
 
     def set_root_hash(self, root_hash):
+        self._flat_index_valid = self.flat_index and \
+            self._flat_index_root() == root_hash
         if root_hash == BLANK_ROOT:
             self.root_node = BLANK_NODE
+            self._size = 0
+            self._node_counts = [0] * len(STATS_FIELDS)
             return
         assert isinstance(root_hash, (str, unicode))
         assert len(root_hash) in [0, 32]
         self.root_node = self._decode_to_node(root_hash)
+        try:
+            record = self._db_get(STATS_PREFIX + root_hash)
+        except KeyError:
+            # not written for this root, counted when first asked for
+            self._size = self._node_counts = None
+            return
+        counts = [int(x) for x in record.split()]
+        self._size, self._node_counts = counts[0], counts[1:]
+        # the root is left out of the node counts, see `_delete_node_storage`
+        _add_node_counts(self._node_counts, self.root_node, -1)
+
+    def _flat_index_root(self):
+        ''' the root hash the flat index is of
+        '''
+        try:
+            return self._db_get(FLAT_INDEX_ROOT_KEY)
+        except KeyError:
+            # no index was written yet, the empty index is of the blank root
+            return BLANK_ROOT
+
+    def rebuild_flat_index(self):
+        ''' write the flat index of the current root and commit
+
+        :return: number of indexed keys
+        '''
+        # delete the old entries, the new index and its root hash are then
+        # written in one commit
+        stale = [k for k, _ in self.db.iterate(FLAT_INDEX_PREFIX)]
+        stale.extend(k for k in self._uncommitted
+                     if k.startswith(FLAT_INDEX_PREFIX))
+        for k in stale:
+            self._uncommitted.pop(k, None)
+            self._deletes.add(k)
+        count = 0
+        for key, value in self.iteritems():
+            self._write_flat(key, value)
+            count += 1
+        self._flat_index_valid = True
+        self.commit()
+        return count
+
+    def verify_flat_index(self):
+        ''' compare the flat index with the items of the current root
+
+        :return: list of (key, value in the trie, value in the index) of
+            the keys that differ, BLANK_NODE for missing values
+        '''
+        if self._flat_index_root() != self.root_hash:
+            raise Exception("Flat index is not of the current root")
+        index = ((k[len(FLAT_INDEX_PREFIX):].decode('hex'), v)
+                 for k, v in self.db.iterate(FLAT_INDEX_PREFIX))
+        return list(_diff_items(self.iteritems(), index))
 
     def clear(self):
         ''' clear all tree data
         '''
+        if self.defer_hashing:
+            self.get_root_hash()
         self._delete_child_stroage(self.root_node)
-        self._delete_node_storage(self.root_node)
-        self.db.commit()
+        self._delete_node_storage(self.root_node, root=True)
         self.root_node = BLANK_NODE
+        self._size = 0
+        self._node_counts = [0] * len(STATS_FIELDS)
+        self._flat_index_valid = False
+        self._autocommit()
+
+    @metrics.timed('commit')
+    def commit(self):
+        ''' store the root node and write all pending changes to the
+        database in one write batch
+        '''
+        root_hash = self.get_root_hash()
+        if self.db.pins_roots and root_hash != BLANK_ROOT:
+            self.db.pin(root_hash)
+        if self._size is not None and root_hash != BLANK_ROOT:
+            self._uncommitted[STATS_PREFIX + root_hash] = \
+                ' '.join(str(x) for x in self._counts())
+        if self._flat_index_valid:
+            self._uncommitted[FLAT_INDEX_ROOT_KEY] = root_hash
+        for key, value in self._uncommitted.iteritems():
+            self.db.put(key, value)
+        for key in self._deletes:
+            self.db.delete_on_commit(key)
+        self._uncommitted.clear()
+        self._deletes.clear()
+        self._pending_stores.clear()
+        self.db.commit()
+
+    def _db_get(self, key):
+        ''' the value of key, written by the trie or in the database
+        '''
+        value = self._uncommitted.get(key)
+        if value is None:
+            if key in self._deletes:
+                raise KeyError(key)
+            return self.db.get(key)
+        return value
+
+    def _write_flat(self, key, value):
+        ''' set the flat index entry of key, a blank value deletes it
+        '''
+        k = FLAT_INDEX_PREFIX + str(key).encode('hex')
+        if value == BLANK_NODE:
+            self._uncommitted.pop(k, None)
+            self._deletes.add(k)
+        else:
+            self._deletes.discard(k)
+            self._uncommitted[k] = value
+
+    def _autocommit(self):
+        if not self._batch_depth and not self.defer_hashing:
+            self.commit()
+
+    @contextlib.contextmanager
+    def batch(self):
+        ''' hold node writes of all updates and deletes in memory and flush
+        them as one write batch when the outermost batch exits. if the body
+        of a batch raises, the trie and its pending writes are rolled back
+        to the start of the batch
+
+        usage:
+
+            with trie.batch():
+                for key, value in items:
+                    trie.update(key, value)
+        '''
+        snapshot = self._snapshot()
+        self._batch_depth += 1
+        try:
+            yield self
+        except:
+            self._restore(snapshot)
+            raise
+        finally:
+            self._batch_depth -= 1
+        if not self._batch_depth:
+            self.commit()
+
+    def _snapshot(self):
+        ''' the state of the trie and its pending writes, which a failed
+        batch is rolled back to
+        '''
+        root_node = self.root_node
+        if root_node != BLANK_NODE:
+            # updates change the root and its dirty sub nodes in place
+            root_node = root_node.copy()
+        node_counts = self._node_counts
+        if node_counts is not None:
+            node_counts = list(node_counts)
+        return (root_node, self._size, node_counts,
+                dict(self._pending_stores), self._flat_index_valid,
+                dict(self._uncommitted), set(self._deletes))
+
+    def _restore(self, snapshot):
+        (self.root_node, self._size, self._node_counts,
+         self._pending_stores, self._flat_index_valid,
+         self._uncommitted, self._deletes) = snapshot
 
     def _delete_child_stroage(self, node):
         node_type = self._get_node_type(node)
         if node_type == NODE_TYPE_BRANCH:
             for item in node[:16]:
-                self._delete_child_stroage(self._decode_to_node(item))
+                self._delete_child_stroage(self._load_node(item))
         elif is_key_value_type(node_type):
             node_type = self._get_node_type(node)
             if node_type == NODE_TYPE_EXTENSION:
-                self._delete_child_stroage(self._decode_to_node(node[1]))
+                self._delete_child_stroage(self._load_node(node[1]))
 
     def _encode_node(self, node):
+        if self.defer_hashing and node != BLANK_NODE:
+            node.dirty = True
+            return node
+        return self._store_node(node)
+
+    def _store_node(self, node):
         if node == BLANK_NODE:
             return BLANK_NODE
-        assert isinstance(node, list)
-        rlpnode = rlp.encode(node)
+        assert isinstance(node, Node)
+        rlpnode = node.rlp
         if len(rlpnode) < 32:
             return node
 
-        hashkey = utils.sha3(rlpnode)
-        self.db.put(hashkey, rlpnode)
+        hashkey = node.hash
+        self._uncommitted[hashkey] = rlpnode
+        self._pending_stores[hashkey] = \
+            self._pending_stores.get(hashkey, 0) + 1
+        if self._node_counts is not None:
+            _add_node_counts(self._node_counts, node, 1)
+        self.node_cache.put(hashkey, node.copy(), len(rlpnode))
         return hashkey
 
-    def _decode_to_node(self, encoded):
+    def _hash_dirty_nodes(self, node):
+        ''' hash and store the dirty descendants of the node bottom up,
+        replacing the in memory references by their encoded form. all the
+        ancestors of a dirty node are dirty, so clean sub nodes are skipped
+
+        :param node: dirty node
+        :return: the node itself
+        '''
+        for i, item in enumerate(node):
+            if isinstance(item, Node) and item.dirty:
+                node[i] = self._store_node(self._hash_dirty_nodes(item))
+        node.dirty = False
+        return node
+
+    def _load_node(self, encoded):
+        ''' like `_decode_to_node`, but the node may be shared with the node
+        cache, so it must not be changed
+        '''
         if encoded == BLANK_NODE:
             return BLANK_NODE
         if isinstance(encoded, list):
             return encoded
-        return rlp.decode(self.db.get(encoded))
+        node = self.node_cache.get(encoded)
+        if node is None:
+            if metrics.ENABLED:
+                metrics.incr('nodes.decoded')
+            rlpnode = self._db_get(encoded)
+            node = to_node(rlp.decode(rlpnode), rlpnode, encoded)
+            self.node_cache.put(encoded, node, len(rlpnode))
+        return node
+
+    def _decode_to_node(self, encoded):
+        # nodes are content addressed, so cached nodes never go stale. the
+        # callers change nodes in place, hence only copies are handed out
+        node = self._load_node(encoded)
+        if isinstance(encoded, list) or node == BLANK_NODE:
+            return node
+        return node.copy()
 
     def _get_node_type(self, node):
         ''' get node type and content
@@ -214,53 +903,77 @@ class Trie(object):
         '''
         if node == BLANK_NODE:
             return NODE_TYPE_BLANK
-
-        if len(node) == 2:
-            nibbles = unpack_to_nibbles(node[0])
-            has_terminator = (nibbles and nibbles[-1] == NIBBLE_TERMINATOR)
-            return NODE_TYPE_LEAF if has_terminator\
-                else NODE_TYPE_EXTENSION
-        if len(node) == 17:
-            return NODE_TYPE_BRANCH
+        return node.node_type
 
     def _get(self, node, key):
         """ get value inside a node
 
         :param node: node in form of list, or BLANK_NODE
-        :param key: nibble list without terminator
+        :param key: NibblePath without terminator
         :return:
             BLANK_NODE if does not exist, otherwise value or hash
         """
-        node_type = self._get_node_type(node)
-        if node_type == NODE_TYPE_BLANK:
-            return BLANK_NODE
+        # the nodes near the root are read by most gets
+        cached_levels = GET_CACHED_LEVELS
+        if self.node_cache.max_entries == 0:
+            cached_levels = 0
+        depth = [0]
+
+        def load_node(encoded):
+            depth[0] += 1
+            return self._peek_node(encoded, depth[0] <= cached_levels)
+
+        return _walk(node, key.tohex(), load_node)
+
+    def _peek_node(self, encoded, cache=False):
+        ''' like `_load_node` for read only walks: a node which is not in
+        the node cache is returned as an :class:`rlp.RLPView` of its stored
+        bytes, so only the items read are decoded. it is not cached, unless
+        cache is set, then it is decoded and cached by `_load_node`
+        '''
+        if encoded == BLANK_NODE or not isinstance(encoded, str):
+            # blank, inlined, or inlined in a view
+            return encoded
+        if cache:
+            return self._load_node(encoded)
+        node = self.node_cache.get(encoded)
+        if node is None:
+            return rlp.RLPView(self._db_get(encoded))
+        return node
 
-        if node_type == NODE_TYPE_BRANCH:
-            # already reach the expected node
-            if not key:
-                return node[-1]
-            sub_node = self._decode_to_node(node[key[0]])
-            return self._get(sub_node, key[1:])
+    @metrics.timed('get_proof')
+    def get_proof(self, key):
+        ''' the proof of the value of key, or that key does not exist: the
+        RLP encoded nodes on the path of key, root first. see
+        :func:`verify_proof`
+        '''
+        return self.get_multi_proof([key])
 
-        # key value node
-        curr_key = without_terminator(unpack_to_nibbles(node[0]))
-        if node_type == NODE_TYPE_LEAF:
-            return node[1] if key == curr_key else BLANK_NODE
+    def get_multi_proof(self, keys):
+        ''' the proof of the values of many keys, the nodes shared by the
+        paths of the keys are included once. see :func:`verify_multi_proof`
+        '''
+        if self.get_root_hash() == BLANK_ROOT:
+            return []
+        proof, seen = [self.root_node.rlp], set()
+
+        def load_node(encoded):
+            node = self._load_node(encoded)
+            if isinstance(encoded, str) and encoded and encoded not in seen:
+                seen.add(encoded)
+                proof.append(node.rlp)
+            return node
 
-        if node_type == NODE_TYPE_EXTENSION:
-            # traverse child nodes
-            if starts_with(key, curr_key):
-                sub_node = self._decode_to_node(node[1])
-                return self._get(sub_node, key[len(curr_key):])
-            else:
-                return BLANK_NODE
+        for key in keys:
+            _walk(self.root_node, str(key).encode('hex'), load_node)
+        return proof
 
     def _update(self, node, key, value):
         """ update item inside a node
 
         :param node: node in form of list, or BLANK_NODE
-        :param key: nibble list without terminator
-            .. note:: key may be []
+        :param key: NibblePath without terminator
+            .. note:: key may be empty
         :param value: value string
         :return: new node
 
@@ -273,12 +986,15 @@ class Trie(object):
 
         if node_type == NODE_TYPE_BLANK:
             if PRINT: print 'blank'
-            return [pack_nibbles(with_terminator(key)), value]
+            self._add_to_size(1)
+            return LeafNode([key.pack(terminator=True), value])
 
         elif node_type == NODE_TYPE_BRANCH:
             if PRINT: print 'branch'
             if not key:
                 if PRINT: print '\tdone', node
+                if node[-1] == BLANK_NODE:
+                    self._add_to_size(1)
                 node[-1] = value
                 if PRINT: print '\t', node
 
@@ -298,25 +1014,45 @@ class Trie(object):
             return self._update_kv_node(node, key, value)
 
     def _update_and_delete_storage(self, node, key, value):
-        old_node = node[:]
+        old_node = node.copy(deep=False) if node != BLANK_NODE else node
         new_node = self._update(node, key, value)
-        if old_node != new_node:
-            self._delete_node_storage(old_node)
+        self._replace_node_storage(node, old_node, new_node)
         return new_node
 
+    def _replace_node_storage(self, node, old_node, new_node):
+        ''' delete the storage of a node that was changed to new_node
+
+        :param node: the node object before it was changed
+        :param old_node: copy of the node taken before it was changed, it
+            keeps the cached encoding and hash of the node
+
+        an unchanged node is replaced as well, its parent stores it again
+
+        .. note::
+
+            with deferred hashing, dirty children are shared by the node and
+            its copy and may be changed in place, so every node on the path
+            of an update is treated as changed and becomes dirty
+        '''
+        root = node is self.root_node
+        if not self.defer_hashing:
+            self._delete_node_storage(old_node, root)
+            return
+        # dirty nodes were never stored
+        if node == BLANK_NODE or not node.dirty:
+            self._delete_node_storage(old_node, root)
+        if new_node != BLANK_NODE:
+            new_node.dirty = True
+
     def _update_kv_node(self, node, key, value):
         node_type = self._get_node_type(node)
-        curr_key = without_terminator(unpack_to_nibbles(node[0]))
+        curr_key = node.path
         is_inner = node_type == NODE_TYPE_EXTENSION
         if PRINT: print 'this node is an extension node?',  is_inner
         if PRINT: print 'cur key, next key', curr_key, key
 
         # find longest common prefix
-        prefix_length = 0
-        for i in range(min(len(curr_key), len(key))):
-            if key[i] != curr_key[i]:
-                break
-            prefix_length = i + 1
+        prefix_length = key.common_prefix_length(curr_key)
 
         remain_key = key[prefix_length:]
         remain_curr_key = curr_key[prefix_length:]
@@ -326,16 +1062,16 @@ class Trie(object):
 
         # if the keys were the same, then either this is a terminal node or not.  if yes, return [key, value]. if not, its an extension node, so the value of this node points to another node, from which we use remaining key.
         
-        if remain_key == [] == remain_curr_key:
+        if not remain_key and not remain_curr_key:
             if PRINT: print 'keys were same', node[0], key
             if not is_inner:
                 if PRINT: print 'not an extension node'
-                return [node[0], value]
+                return LeafNode([node[0], value])
             if PRINT: print 'yes an extension node!'
             new_node = self._update_and_delete_storage(
                 self._decode_to_node(node[1]), remain_key, value)
 
-        elif remain_curr_key == []:
+        elif not remain_curr_key:
             if PRINT: print 'old key exhausted'
             if is_inner:
                 if PRINT: print '\t is extension', self._decode_to_node(node[1])
@@ -343,65 +1079,80 @@ class Trie(object):
                     self._decode_to_node(node[1]), remain_key, value)
             else:
                 if PRINT: print '\tnew branch'
-                new_node = [BLANK_NODE] * 17
+                self._add_to_size(1)
+                new_node = BranchNode([BLANK_NODE] * 17)
                 new_node[-1] = node[1]
-                new_node[remain_key[0]] = self._encode_node([
-                    pack_nibbles(with_terminator(remain_key[1:])),
+                new_node[remain_key[0]] = self._encode_node(LeafNode([
+                    remain_key[1:].pack(terminator=True),
                     value
-                ])
+                ]))
             if PRINT: print new_node
         else:
             if PRINT:  print 'making a branch'
-            new_node = [BLANK_NODE] * 17
+            self._add_to_size(1)
+            new_node = BranchNode([BLANK_NODE] * 17)
             if len(remain_curr_key) == 1 and is_inner:
                 if PRINT: print 'key done and is inner'
                 new_node[remain_curr_key[0]] = node[1]
             else:
                 if PRINT: print 'key not done or not inner', node, key, value
                 if PRINT: print remain_curr_key
-                new_node[remain_curr_key[0]] = self._encode_node([
-                    pack_nibbles(
-                        adapt_terminator(remain_curr_key[1:], not is_inner)
-                    ),
-                    node[1]
-                ])
-
-            if remain_key == []:
+                new_node[remain_curr_key[0]] = self._encode_node(
+                    node.__class__([
+                        remain_curr_key[1:].pack(terminator=not is_inner),
+                        node[1]
+                    ]))
+
+            if not remain_key:
                 new_node[-1] = value
             else:
-                new_node[remain_key[0]] = self._encode_node([
-                    pack_nibbles(with_terminator(remain_key[1:])), value
-                ])
+                new_node[remain_key[0]] = self._encode_node(LeafNode([
+                    remain_key[1:].pack(terminator=True), value
+                ]))
             if PRINT: print new_node
 
         if prefix_length:
             # create node for key prefix
             if PRINT: print 'prefix length', prefix_length
-            new_node= [pack_nibbles(curr_key[:prefix_length]),
-                    self._encode_node(new_node)]
+            new_node = ExtensionNode([curr_key[:prefix_length].pack(),
+                                      self._encode_node(new_node)])
             if PRINT: print 'new node type', self._get_node_type(new_node)
             return new_node
         else:
             return new_node
 
-    def _delete_node_storage(self, node):
+    def _delete_node_storage(self, node, root=False):
         '''delete storage
         :param node: node in form of list, or BLANK_NODE
+        :param root: the node is the root. the root is not in the node
+            counts, it is added by `_counts`
         '''
         if node == BLANK_NODE:
             return
-        assert isinstance(node, list)
-        encoded = self._encode_node(node)
-        if len(encoded) < 32:
+        assert isinstance(node, Node)
+        # the cached encoding and hash of the node are used if present. the
+        # node is not put in the node cache, its inlined sub nodes may be
+        # shared with the node that replaced it
+        rlpnode = node.rlp
+        if len(rlpnode) < 32:
+            return
+        hashkey = node.hash
+        if not root and self._node_counts is not None:
+            _add_node_counts(self._node_counts, node, -1)
+        # the pending write is kept while other places still store it
+        stores = self._pending_stores.pop(hashkey, 0) - 1
+        if stores > 0:
+            self._pending_stores[hashkey] = stores
             return
-        self.db.delete(encoded)
+        # the committed node is kept, other roots may reference it
+        self._uncommitted.pop(hashkey, None)
 
     def _delete(self, node, key):
         """ update item inside a node
 
         :param node: node in form of list, or BLANK_NODE
-        :param key: nibble list without terminator
-            .. note:: key may be []
+        :param key: NibblePath without terminator
+            .. note:: key may be empty
         :return: new node
 
         if this node is changed to a new node, it's parent will take the
@@ -432,33 +1183,38 @@ class Trie(object):
 
         # the value item is not blank
         if not_blank_index == 16:
-            return [pack_nibbles(with_terminator([])), node[16]]
+            return LeafNode([pack_hex('', 2), node[16]])
 
         # normal item is not blank
         sub_node = self._decode_to_node(node[not_blank_index])
         sub_node_type = self._get_node_type(sub_node)
+        # the sub node is merged into the new node or stored again below it
+        if not sub_node.dirty:
+            self._delete_node_storage(sub_node)
 
         if is_key_value_type(sub_node_type):
             # collape subnode to this node, not this node will have same
             # terminator with the new sub node, and value does not change
-            new_key = [not_blank_index] + \
-                unpack_to_nibbles(sub_node[0])
-            return [pack_nibbles(new_key), sub_node[1]]
+            new_key = pack_hex(
+                HEX_NIBBLES[not_blank_index] + sub_node.path.hex,
+                2 if sub_node_type == NODE_TYPE_LEAF else 0)
+            return sub_node.__class__([new_key, sub_node[1]])
         if sub_node_type == NODE_TYPE_BRANCH:
-            return [pack_nibbles([not_blank_index]),
-                    self._encode_node(sub_node)]
+            return ExtensionNode([pack_hex(HEX_NIBBLES[not_blank_index]),
+                                  self._encode_node(sub_node)])
         assert False
 
     def _delete_and_delete_storage(self, node, key):
-        old_node = node[:]
+        old_node = node.copy(deep=False) if node != BLANK_NODE else node
         new_node = self._delete(node, key)
-        if old_node != new_node:
-            self._delete_node_storage(old_node)
+        self._replace_node_storage(node, old_node, new_node)
         return new_node
 
     def _delete_branch_node(self, node, key):
         # already reach the expected node
         if not key:
+            if node[-1] != BLANK_NODE:
+                self._add_to_size(-1)
             node[-1] = BLANK_NODE
             return self._normalize_branch_node(node)
 
@@ -468,6 +1224,9 @@ class Trie(object):
         )
 
         if encoded_new_sub_node == node[key[0]]:
+            if isinstance(encoded_new_sub_node, Node):
+                # an inlined sub node may have changed in place
+                node[key[0]] = encoded_new_sub_node
             return node
 
         node[key[0]] = encoded_new_sub_node
@@ -479,20 +1238,27 @@ class Trie(object):
     def _delete_kv_node(self, node, key):
         node_type = self._get_node_type(node)
         assert is_key_value_type(node_type)
-        curr_key = without_terminator(unpack_to_nibbles(node[0]))
+        curr_key = node.path
 
-        if not starts_with(key, curr_key):
+        if not key.startswith(curr_key):
             # key not found
             return node
 
         if node_type == NODE_TYPE_LEAF:
-            return BLANK_NODE if key == curr_key else node
+            if key != curr_key:
+                return node
+            self._add_to_size(-1)
+            return BLANK_NODE
 
         # for inner key value type
         new_sub_node = self._delete_and_delete_storage(
             self._decode_to_node(node[1]), key[len(curr_key):])
 
-        if self._encode_node(new_sub_node) == node[1]:
+        encoded_new_sub_node = self._encode_node(new_sub_node)
+        if encoded_new_sub_node == node[1]:
+            if isinstance(encoded_new_sub_node, Node):
+                # an inlined sub node may have changed in place
+                node[1] = encoded_new_sub_node
             return node
 
         # new sub node is BLANK_NODE
@@ -507,15 +1273,19 @@ class Trie(object):
         if is_key_value_type(new_sub_node_type):
             # collape subnode to this node, not this node will have same
             # terminator with the new sub node, and value does not change
-            new_key = curr_key + unpack_to_nibbles(new_sub_node[0])
-            return [pack_nibbles(new_key), new_sub_node[1]]
+            new_key = pack_hex(curr_key.tohex() + new_sub_node.path.hex,
+                               2 if new_sub_node_type == NODE_TYPE_LEAF else 0)
+            if not new_sub_node.dirty:
+                self._delete_node_storage(new_sub_node)
+            return new_sub_node.__class__([new_key, new_sub_node[1]])
 
         if new_sub_node_type == NODE_TYPE_BRANCH:
-            return [pack_nibbles(curr_key), self._encode_node(new_sub_node)]
+            return ExtensionNode([curr_key.pack(), encoded_new_sub_node])
 
         # should be no more cases
         assert False
 
+    @metrics.timed('delete')
     def delete(self, key):
         '''
         :param key: a string with length of [0, 32]
@@ -528,92 +1298,372 @@ class Trie(object):
 
         self.root_node = self._delete_and_delete_storage(
             self.root_node,
-            bin_to_nibbles(str(key)))
-        self.get_root_hash()
-        self.db.commit()
+            NibblePath.from_bin(str(key)))
+        if self._flat_index_valid:
+            self._write_flat(key, BLANK_NODE)
+        if not self.defer_hashing:
+            self.get_root_hash()
+        self._autocommit()
+
+    def _add_to_size(self, delta):
+        ''' count an added or deleted item, if the count is known
+        '''
+        if self._size is not None:
+            self._size += delta
 
-    def _get_size(self, node):
-        '''Get counts of (key, value) stored in this and the descendant nodes
+    @metrics.timed('to_dict')
+    def to_dict(self):
+        return dict(self.iteritems())
 
-        :param node: node in form of list, or BLANK_NODE
+    def iteritems(self):
+        ''' iterate over the (key, value) items in key order. the trie is
+        walked depth first and the nodes are decoded when they are reached,
+        so only the path to the current item is held in memory
         '''
-        if node == BLANK_NODE:
-            return 0
+        return self._iter_items(self.root_node)
 
-        node_type = self._get_node_type(node)
+    def iter_range(self, start='', end=None):
+        ''' iterate over the (key, value) items with start <= key < end in
+        key order. the walk seeks down to start and only decodes the nodes
+        of the range
 
-        if is_key_value_type(node_type):
-            value_is_node = node_type == NODE_TYPE_EXTENSION
-            if value_is_node:
-                return self._get_size(self._decode_to_node(node[1]))
-            else:
-                return 1
-        elif node_type == NODE_TYPE_BRANCH:
-            sizes = [self._get_size(self._decode_to_node(node[x]))
-                     for x in range(16)]
-            sizes = sizes + [1 if node[-1] else 0]
-            return sum(sizes)
+        :param end: None for no upper limit
+        '''
+        return self._iter_items(self.root_node, start.encode('hex'),
+                                None if end is None else end.encode('hex'))
 
-    def _to_dict(self, node):
-        '''convert (key, value) stored in this and the descendant nodes
-        to dict items.
+    def iter_prefix(self, prefix):
+        ''' iterate over the (key, value) items of the keys starting with
+        prefix in key order
+        '''
+        for key, value in self.iter_range(prefix):
+            if not key.startswith(prefix):
+                return
+            yield key, value
+
+    def cursor(self, start='', end=None):
+        ''' a resumable :class:`Cursor` over the items of the current root
+        with start <= key < end
+        '''
+        return Cursor(self, self.root_hash, start, end)
 
+    def _iter_items(self, node, start='', end=None, prefix=''):
+        '''
         :param node: node in form of list, or BLANK_NODE
-
-        .. note::
-
-            Here key is in full form, rather than key of the individual node
+        :param start: hex string of the first key
+        :param end: hex string of the key after the last one, None for no
+            upper limit
+        :param prefix: hex string of the key up to the node
         '''
-        if node == BLANK_NODE:
-            return {}
-
-        node_type = self._get_node_type(node)
-
-        if is_key_value_type(node_type):
-            nibbles = without_terminator(unpack_to_nibbles(node[0]))
-            key = '+'.join([str(x) for x in nibbles])
-            if node_type == NODE_TYPE_EXTENSION:
-                sub_dict = self._to_dict(self._decode_to_node(node[1]))
+        # stack of (encoded node, hex string of the key up to the node),
+        # the next node to visit on top
+        stack = [(node, prefix)]
+        while stack:
+            encoded, path = stack.pop()
+            # every key below the node starts with path
+            if end is not None and path >= end:
+                return
+            node = self._load_node(encoded)
+            node_type = self._get_node_type(node)
+            if node_type == NODE_TYPE_BLANK:
+                continue
+
+            if node_type == NODE_TYPE_BRANCH:
+                for i in range(15, -1, -1):
+                    if node[i] == BLANK_NODE:
+                        continue
+                    sub_path = path + HEX_NIBBLES[i]
+                    # skip the sub nodes of which all keys are before start
+                    if sub_path >= start[:len(sub_path)]:
+                        stack.append((node[i], sub_path))
+                # the value of the branch sorts before its sub nodes
+                if node[16] and path >= start:
+                    yield path.decode('hex'), node[16]
+                continue
+
+            path += node.path.hex
+            if node_type == NODE_TYPE_LEAF:
+                if path >= start and (end is None or path < end):
+                    yield path.decode('hex'), node[1]
+            elif path >= start[:len(path)]:
+                stack.append((node[1], path))
+
+    def diff(self, old_root, new_root):
+        ''' iterate over the (key, old value, new value) of the keys whose
+        values differ between two roots, in key order. BLANK_NODE stands
+        for a missing value. the two tries are walked side by side, sub
+        tries with the same hash are skipped. where one side is blank or a
+        leaf, the items below both sides are compared instead
+        '''
+        # stack of (hex string of the key, old view, new view), see
+        # `_resolve_view`
+        stack = [('', (old_root, 0), (new_root, 0))]
+        while stack:
+            path, old_view, new_view = stack.pop()
+            if old_view == new_view:
+                continue
+            old_view, old_node = self._resolve_view(old_view)
+            new_view, new_node = self._resolve_view(new_view)
+            if old_view == new_view:
+                continue
+            if old_node == BLANK_NODE or new_node == BLANK_NODE or \
+                    old_node.node_type == NODE_TYPE_LEAF or \
+                    new_node.node_type == NODE_TYPE_LEAF:
+                for change in _diff_items(self._view_items(path, old_view),
+                                          self._view_items(path, new_view)):
+                    yield change
+                continue
+            old_value, old_subs = self._expand_view(old_view, old_node)
+            new_value, new_subs = self._expand_view(new_view, new_node)
+            for i in range(15, -1, -1):
+                if i in old_subs or i in new_subs:
+                    stack.append((path + HEX_NIBBLES[i],
+                                  old_subs.get(i, (BLANK_NODE, 0)),
+                                  new_subs.get(i, (BLANK_NODE, 0))))
+            if old_value != new_value:
+                yield path.decode('hex'), old_value, new_value
+
+    def _resolve_view(self, view):
+        ''' a view is (encoded node, offset) of the position offset nibbles
+        into the key of the node, 0 for a branch node. the offset moves
+        along the key of an extension node, so both sides of a diff are
+        walked one nibble at a time whatever their node types. at the end
+        of the key the view moves on to the child
+
+        :return: (view, node)
+        '''
+        encoded, offset = view
+        node = self._load_node(encoded)
+        while node != BLANK_NODE and \
+                node.node_type == NODE_TYPE_EXTENSION and \
+                offset == len(node.path):
+            encoded, offset = node[1], 0
+            node = self._load_node(encoded)
+        return (encoded, offset), node
+
+    def _expand_view(self, view, node):
+        ''' :return: (value, dict of the views one nibble down by the
+        nibble) of the resolved view of a branch or extension node
+        '''
+        encoded, offset = view
+        if node.node_type == NODE_TYPE_BRANCH:
+            return node[16], dict((i, (node[i], 0)) for i in range(16)
+                                  if node[i] != BLANK_NODE)
+        return BLANK_NODE, {
+            NIBBLE_VALUES[node.path.hex[offset]]: (encoded, offset + 1)}
+
+    def _view_items(self, path, view):
+        ''' the (key, value) items below the view at hex key path '''
+        encoded, offset = view
+        return self._iter_items(encoded, prefix=path[:len(path) - offset])
+
+    def export(self, root_hash, fileobj, progress=None):
+        ''' write the state of root_hash to fileobj: a record of the root
+        hash, then a record of every node stored by hash below the root,
+        parents before their children. a record is a 4 byte big endian
+        length and the bytes. only the stack of the walk is kept in memory
+
+        :param progress: called with (nodes, bytes) written so far every
+            PROGRESS_INTERVAL nodes
+        :return: (nodes, bytes) written
+        '''
+        nodes, size = 0, _write_record(fileobj, root_hash)
+        stack = [] if root_hash == BLANK_ROOT else [root_hash]
+        while stack:
+            rlpnode = self._db_get(stack.pop())
+            size += _write_record(fileobj, rlpnode)
+            nodes += 1
+            stack.extend(refcount.node_refs(rlpnode))
+            if progress and not nodes % PROGRESS_INTERVAL:
+                progress(nodes, size)
+        return nodes, size
+
+    def import_(self, fileobj, progress=None):
+        ''' load a state written by :meth:`export` into the database, in
+        write batches of IMPORT_BATCH_SIZE nodes, and set the root of the
+        trie to it. the importer walks the nodes in the order of the
+        export, so every node is checked against the hash its parent
+        references while only the stack of the walk is kept in memory
+
+        :param progress: called with (nodes, bytes) read so far every
+            PROGRESS_INTERVAL nodes
+        :return: (nodes, bytes) read
+        :raises: Exception if a node does not match its hash or the file
+            lacks nodes or has more
+        '''
+        root_hash = _read_record(fileobj)
+        if root_hash is None:
+            raise Exception("Empty export file")
+        nodes, size = 0, 4 + len(root_hash)
+        stack = [] if root_hash == BLANK_ROOT else [root_hash]
+        while stack:
+            encoded = stack.pop()
+            rlpnode = _read_record(fileobj)
+            if rlpnode is None:
+                raise Exception("Export file lacks node %s"
+                                % encoded.encode('hex'))
+            if utils.sha3(rlpnode) != encoded:
+                raise Exception("Node %d does not match hash %s"
+                                % (nodes, encoded.encode('hex')))
+            self.db.put(encoded, rlpnode)
+            size += 4 + len(rlpnode)
+            nodes += 1
+            stack.extend(refcount.node_refs(rlpnode))
+            if not nodes % IMPORT_BATCH_SIZE:
+                self.db.commit()
+            if progress and not nodes % PROGRESS_INTERVAL:
+                progress(nodes, size)
+        if _read_record(fileobj) is not None:
+            raise Exception("Export file has records after the last node")
+        self.set_root_hash(root_hash)
+        self.commit()
+        return nodes, size
+
+    def analyze(self, root_hash=None, progress=None):
+        ''' the shape and storage of a root. the nodes are streamed from
+        the database depth first, only the stack of the walk and the
+        histograms are kept in memory. depths count nodes, the root is at
+        depth 0
+
+        :param root_hash: the current root if None
+        :param progress: called with the number of nodes walked every
+            PROGRESS_INTERVAL nodes
+        :return: dict of
+            items: number of values
+            nodes: {node type: number of nodes}, inlined nodes included
+            references: {'hashed': n, 'inlined': n} of the sub node
+                references, see `_encode_node`
+            stored_bytes: total size of the nodes stored by hash
+            nodes_by_depth, bytes_by_depth: {depth: nodes, stored bytes}
+            item_depths: {depth of the node holding a value: items}
+            item_reads: {stored nodes on the path of a value, i.e. database
+                reads of its lookup: items}
+            branch_fanout: {non blank sub nodes of a branch node: nodes}
+        '''
+        if root_hash is None:
+            root_hash = self.get_root_hash()
+        result = dict(items=0, stored_bytes=0,
+                      nodes=dict(branch=0, extension=0, leaf=0),
+                      references=dict(hashed=0, inlined=0),
+                      nodes_by_depth={}, bytes_by_depth={}, item_depths={},
+                      item_reads={}, branch_fanout={})
+
+        def count(histogram, key, value=1):
+            histogram[key] = histogram.get(key, 0) + value
+
+        def add_item(depth, reads):
+            result['items'] += 1
+            count(result['item_depths'], depth)
+            count(result['item_reads'], reads)
+
+        def add_ref(child, depth, reads):
+            result['references'][
+                'inlined' if isinstance(child, list) else 'hashed'] += 1
+            stack.append((child, depth + 1, reads))
+
+        # (encoded node, depth, stored nodes on the path above)
+        stack = [] if root_hash == BLANK_ROOT else [(root_hash, 0, 0)]
+        walked = 0
+        while stack:
+            encoded, depth, reads = stack.pop()
+            if isinstance(encoded, list):
+                node = encoded
             else:
-                sub_dict = {str(NIBBLE_TERMINATOR): node[1]}
-
-            # prepend key of this node to the keys of children
-            res = {}
-            for sub_key, sub_value in sub_dict.iteritems():
-                full_key = '{0}+{1}'.format(key, sub_key).strip('+')
-                res[full_key] = sub_value
-            return res
-
-        elif node_type == NODE_TYPE_BRANCH:
-            res = {}
-            for i in range(16):
-                sub_dict = self._to_dict(self._decode_to_node(node[i]))
-
-                for sub_key, sub_value in sub_dict.iteritems():
-                    full_key = '{0}+{1}'.format(i, sub_key).strip('+')
-                    res[full_key] = sub_value
+                rlpnode = self._db_get(encoded)
+                node = rlp.decode(rlpnode)
+                reads += 1
+                result['stored_bytes'] += len(rlpnode)
+                count(result['bytes_by_depth'], depth, len(rlpnode))
+            count(result['nodes_by_depth'], depth)
+            walked += 1
+            if progress and not walked % PROGRESS_INTERVAL:
+                progress(walked)
+
+            if len(node) == 17:
+                result['nodes']['branch'] += 1
+                children = [x for x in node[:16] if x != BLANK_NODE]
+                count(result['branch_fanout'], len(children))
+                if node[16] != BLANK_NODE:
+                    add_item(depth, reads)
+                for child in reversed(children):
+                    add_ref(child, depth, reads)
+            elif unpack_to_hex(node[0])[1]:
+                result['nodes']['leaf'] += 1
+                add_item(depth, reads)
+            else:
+                result['nodes']['extension'] += 1
+                add_ref(node[1], depth, reads)
+        return result
 
-            if node[16]:
-                res[str(NIBBLE_TERMINATOR)] = node[-1]
-            return res
+    def iterkeys(self):
+        for key, _ in self.iteritems():
+            yield key
 
-    def to_dict(self):
-        d = self._to_dict(self.root_node)
-        res = {}
-        for key_str, value in d.iteritems():
-            if key_str:
-                nibbles = [int(x) for x in key_str.split('+')]
-            else:
-                nibbles = []
-            key = nibbles_to_bin(without_terminator(nibbles))
-            res[key] = value
-        return res
+    def itervalues(self):
+        for _, value in self.iteritems():
+            yield value
 
+    @metrics.timed('get')
     def get(self, key):
-        return self._get(self.root_node, bin_to_nibbles(str(key)))
+        if self._flat_index_valid:
+            try:
+                return self._db_get(
+                    FLAT_INDEX_PREFIX + str(key).encode('hex'))
+            except KeyError:
+                return BLANK_NODE
+        return self._get(self.root_node, NibblePath.from_bin(str(key)))
 
     def __len__(self):
-        return self._get_size(self.root_node)
+        if self._size is None:
+            self._count_nodes()
+        return self._size
+
+    def stats(self):
+        ''' statistics of the current root: the number of items, the number
+        of leaf, extension and branch nodes, inlined ones included, and the
+        number and total size of the nodes stored by hash, the root
+        included. the counts are kept by updates and deletes and written by
+        commits, the nodes of a root without written counts are walked once
+        '''
+        self.get_root_hash()
+        return dict(zip(('items',) + STATS_FIELDS, self._counts()))
+
+    def _counts(self):
+        ''' the items and the STATS_FIELDS of the current root, whose root
+        hash is computed
+        '''
+        if self._size is None:
+            self._count_nodes()
+        counts = list(self._node_counts)
+        if self.root_node != BLANK_NODE:
+            _add_node_counts(counts, self.root_node, 1)
+        return [self._size] + counts
+
+    def _count_nodes(self):
+        ''' walk the nodes of the current root to count the items and the
+        nodes
+        '''
+        root_hash = self.get_root_hash()
+        items, counts = 0, [0] * len(STATS_FIELDS)
+        stack = [] if root_hash == BLANK_ROOT else [root_hash]
+        while stack:
+            encoded = stack.pop()
+            node = self._load_node(encoded)
+            if not isinstance(encoded, list):
+                counts[0] += 1
+                counts[4] += len(node.rlp)
+            counts[node.node_type] += 1
+            if node.node_type == NODE_TYPE_BRANCH:
+                if node[16] != BLANK_NODE:
+                    items += 1
+                stack.extend(x for x in node[:16] if x != BLANK_NODE)
+            elif node.node_type == NODE_TYPE_EXTENSION:
+                stack.append(node[1])
+            else:
+                items += 1
+        if root_hash != BLANK_ROOT:
+            _add_node_counts(counts, self.root_node, -1)
+        self._size, self._node_counts = items, counts
 
     def __getitem__(self, key):
         return self.get(key)
@@ -625,11 +1675,12 @@ class Trie(object):
         return self.delete(key)
 
     def __iter__(self):
-        return iter(self.to_dict())
+        return self.iterkeys()
 
     def __contains__(self, key):
         return self.get(key) != BLANK_NODE
 
+    @metrics.timed('update')
     def update(self, key, value):
         '''
         :param key: a string with length of [0, 32]
@@ -649,18 +1700,220 @@ class Trie(object):
 
         self.root_node = self._update_and_delete_storage(
             self.root_node,
-            bin_to_nibbles(str(key)),
+            NibblePath.from_bin(str(key)),
             value)
+        if self._flat_index_valid:
+            self._write_flat(key, value)
         if PRINT: print 'root hash before db commit', self.get_root_hash().encode('hex')
-        self.db.commit()
+        self._autocommit()
+
+    @classmethod
+    def from_sorted_items(cls, dbfile, items, **kwargs):
+        ''' build a trie from (key, value) items in increasing key order,
+        writing every node once, see :class:`TrieBuilder`
+
+        :param kwargs: passed on to :class:`Trie`
+        '''
+        database = dbfile if isinstance(dbfile, DB) else DB(dbfile)
+        root_hash = TrieBuilder(database).build(items)
+        database.commit()
+        return cls(database, root_hash, **kwargs)
 
     def root_hash_valid(self):
         if self.root_hash == BLANK_ROOT:
             return True
-        return self.root_hash in self.db
+        root_hash = self.root_hash
+        return root_hash in self._uncommitted or root_hash in self.db
+
+
+class TrieBuilder(object):
+    ''' build a trie from items added in increasing key order in one pass.
+    only the open branch nodes on the path of the last key are held, a
+    subtree is encoded and stored once no later key can fall into it
+
+    usage:
+
+        builder = TrieBuilder(db)
+        for key, value in sorted_items:
+            builder.add(key, value)
+        root_hash = builder.finish()
+
+    the root hash is the same as of a :class:`Trie` with the items updated
+    in any order. the nodes are put in the database but not committed. on a
+    database which pins roots the root is pinned for the next commit, as
+    :meth:`Trie.commit` does
+    '''
+
+    def __init__(self, dbfile=None):
+        '''
+        :param dbfile: as for :class:`Trie`, None to only compute the root
+            hash without storing any node
+        '''
+        if dbfile is not None and not isinstance(dbfile, DB):
+            dbfile = DB(dbfile)
+        self.db = dbfile
+        # open branches as (depth, BranchNode), deepest on top. a branch at
+        # depth d is at the first d nibbles of the last key
+        self.stack = []
+        # (hex key, value) of the last key, placed once the next key is known
+        self.last = None
+
+    def add(self, key, value):
+        if not isinstance(key, (str, unicode)):
+            raise Exception("Key must be string")
+
+        if len(key) > 32:
+            raise Exception("Max key length is 32")
+
+        if not isinstance(value, (str, unicode)):
+            raise Exception("Value must be string")
+
+        if value == '':
+            return
+
+        self._add_subtree((str(key).encode('hex'), value))
+
+    def _add_subtree(self, subtree):
+        ''' add a finished subtree as if its keys were added one by one, see
+        `_attach`. its keys must all be after the keys added before
+        '''
+        path = subtree[0]
+        if self.last is not None:
+            if path <= self.last[0]:
+                raise Exception("Keys must be added in increasing order")
+            depth = NibblePath(path).common_prefix_length(
+                NibblePath(self.last[0]))
+            last = self._close(depth)
+            if not self.stack or self.stack[-1][0] < depth:
+                self.stack.append((depth, BranchNode([BLANK_NODE] * 17)))
+            self._attach(self.stack[-1][1], depth, last)
+        self.last = subtree
+
+    def build(self, items):
+        ''' add the (key, value) items and finish
+        '''
+        for key, value in items:
+            self.add(key, value)
+        return self.finish()
+
+    def build_parallel(self, items, processes=None, nibbles=1):
+        ''' like `build`, but the items are split by their first nibbles and
+        the subtrees are built by a pool of processes. the subtrees are then
+        added to this builder, which builds the nodes above them
+
+        :param processes: size of the pool, defaults to the number of CPUs
+        :param nibbles: split by the first 1 (16 subtrees) or 2 (256
+            subtrees) nibbles
+        '''
+        if nibbles not in (1, 2):
+            raise Exception("Items can be split by 1 or 2 nibbles")
+        if self.last is not None:
+            raise Exception("Builder must be empty")
+        store = self.db is not None
+        groups = itertools.groupby(
+            items, lambda item: str(item[0])[:1].encode('hex')[:nibbles])
+        pool = multiprocessing.Pool(processes)
+        try:
+            for result in pool.imap(
+                    _build_subtree,
+                    ((list(group), store) for _, group in groups)):
+                if result is None:
+                    continue
+                path, value, branch, nodes = result
+                for key, rlpnode in nodes:
+                    self.db.put(key, rlpnode)
+                if branch is not None:
+                    value = to_node(rlp.decode(branch), branch)
+                self._add_subtree((path, value))
+        finally:
+            pool.close()
+            pool.join()
+        return self.finish()
+
+    def finish(self):
+        ''' store the remaining nodes and the root node and reset the builder
+
+        :return: the root hash
+        '''
+        if self.last is None:
+            return BLANK_ROOT
+        root = self._node_at(self._close(-1), 0)
+        self.last = None
+        if self.db is not None:
+            self.db.put(root.hash, root.rlp)
+            if self.db.pins_roots:
+                self.db.pin(root.hash)
+        return root.hash
+
+    def _close(self, depth):
+        ''' finish the branches deeper than depth, which no later key can
+        reach
+
+        :return: the finished subtree holding the last key, see `_attach`
+        '''
+        subtree = self.last
+        while self.stack and self.stack[-1][0] > depth:
+            branch_depth, branch = self.stack.pop()
+            self._attach(branch, branch_depth, subtree)
+            subtree = (subtree[0][:branch_depth], branch)
+        return subtree
+
+    def _attach(self, branch, depth, subtree):
+        '''
+        :param subtree: a finished subtree, (hex key, value) of a single key
+            or (hex key up to the branch, BranchNode)
+        '''
+        path, node = subtree
+        if len(path) == depth:
+            branch[16] = node
+        else:
+            branch[NIBBLE_VALUES[path[depth]]] = self._store(
+                self._node_at(subtree, depth + 1))
+
+    def _node_at(self, subtree, depth):
+        ''' the node of the subtree when its key starts at nibble depth
+        '''
+        path, node = subtree
+        if not isinstance(node, BranchNode):
+            return LeafNode([pack_hex(path[depth:], 2), node])
+        if len(path) == depth:
+            return node
+        return ExtensionNode([pack_hex(path[depth:]), self._store(node)])
+
+    def _store(self, node):
+        rlpnode = node.rlp
+        if len(rlpnode) < 32:
+            return node
+        if self.db is not None:
+            self.db.put(node.hash, rlpnode)
+        return node.hash
+
+
+def _build_subtree(args):
+    ''' build the subtree of items in a worker of
+    :meth:`TrieBuilder.build_parallel`
+
+    :return: None if all the values are blank, otherwise (path, value,
+        branch, nodes). the subtree is (path, value) or the RLP encoded
+        branch at path, nodes are the (hash, rlp) of the stored nodes
+    '''
+    items, store = args
+    database = DB(db.MemoryBackend()) if store else None
+    builder = TrieBuilder(database)
+    for key, value in items:
+        builder.add(key, value)
+    if builder.last is None:
+        return None
+    path, node = builder._close(-1)
+    nodes = database.uncommitted.items() if store else []
+    if isinstance(node, BranchNode):
+        return path, None, node.rlp, nodes
+    return path, node, None, nodes
+
 
 if __name__ == "__main__":
     import sys
+    import time
 
     def encode_node(nd):
         if isinstance(nd, str):
@@ -676,3 +1929,64 @@ if __name__ == "__main__":
         elif sys.argv[1] == 'get':
             t = Trie(sys.argv[2], sys.argv[3].decode('hex'))
             print t.get(sys.argv[4])
+        elif sys.argv[1] == 'flat-rebuild':
+            t = Trie(sys.argv[2], sys.argv[3].decode('hex'), flat_index=True)
+            print 'indexed', t.rebuild_flat_index(), 'keys'
+        elif sys.argv[1] == 'flat-verify':
+            t = Trie(sys.argv[2], sys.argv[3].decode('hex'), flat_index=True)
+            diffs = t.verify_flat_index()
+            for key, value, indexed in diffs:
+                print key.encode('hex'), repr(value), repr(indexed)
+            print 'ok' if not diffs else '%d keys differ' % len(diffs)
+            sys.exit(1 if diffs else 0)
+        elif sys.argv[1] == 'analyze':
+            t = Trie(sys.argv[2], sys.argv[3].decode('hex'))
+            report = t.analyze(progress=lambda nodes: sys.stderr.write(
+                '%d nodes\n' % nodes))
+
+            def histogram(title, data, unit=''):
+                print title
+                total = float(sum(data.values())) or 1
+                for key in sorted(data):
+                    print '  %3d  %12d%s  %5.1f%%' % (
+                        key, data[key], unit, data[key] / total * 100)
+
+            def mean(data):
+                total = sum(data.values())
+                return sum(k * v for k, v in data.items()) / float(total) \
+                    if total else 0
+
+            nodes = sum(report['nodes'].values())
+            print 'items            %d' % report['items']
+            print 'nodes            %d (branch %d, extension %d, leaf %d)' % (
+                nodes, report['nodes']['branch'],
+                report['nodes']['extension'], report['nodes']['leaf'])
+            print 'references       hashed %d, inlined %d' % (
+                report['references']['hashed'],
+                report['references']['inlined'])
+            print 'stored bytes     %d' % report['stored_bytes']
+            print 'mean item depth  %.2f nodes, %.2f reads per lookup' % (
+                mean(report['item_depths']), mean(report['item_reads']))
+            histogram('nodes by depth', report['nodes_by_depth'])
+            histogram('stored bytes by depth', report['bytes_by_depth'], 'B')
+            histogram('items by depth', report['item_depths'])
+            histogram('items by reads per lookup', report['item_reads'])
+            histogram('branch nodes by fan-out', report['branch_fanout'])
+        elif sys.argv[1] in ('export', 'import'):
+            start = time.time()
+
+            def report(nodes, size):
+                elapsed = max(time.time() - start, 1e-6)
+                sys.stderr.write('%d nodes, %.1f MB, %.0f nodes/s, %.1f MB/s\n'
+                                 % (nodes, size / 1e6, nodes / elapsed,
+                                    size / 1e6 / elapsed))
+
+            if sys.argv[1] == 'export':
+                t = Trie(sys.argv[2], sys.argv[3].decode('hex'))
+                with open(sys.argv[4], 'wb') as f:
+                    report(*t.export(t.root_hash, f, report))
+            else:
+                t = Trie(sys.argv[2])
+                with open(sys.argv[3], 'rb') as f:
+                    report(*t.import_(f, report))
+                print encode_node(t.root_hash)
@@ -1,12 +1,14 @@
 import logging
 import logging.config
-from sha3 import sha3_256
+import hashlib
+import sha3 as _sha3
 from bitcoin import privtopub
 import struct
 import os
 import sys
 import rlp
 import db
+import metrics
 import random
 from rlp import big_endian_to_int, int_to_big_endian
 
@@ -27,7 +29,24 @@ def debug(label):
     return deb
 
 
+# hash function of sha3, selected at import by the TRIE_SHA3_BACKEND
+# environment variable. the backends do not give the same hashes, keccak is
+# the hash of ethereum, sha3 and hashlib are the final SHA3 standard
+SHA3_BACKENDS = {
+    'sha3': lambda: _sha3.sha3_256,
+    'keccak': lambda: _sha3.keccak_256,
+    'hashlib': lambda: hashlib.sha3_256,
+}
+SHA3_BACKEND = os.environ.get('TRIE_SHA3_BACKEND', 'sha3')
+if SHA3_BACKEND not in SHA3_BACKENDS:
+    raise Exception("Unknown sha3 backend %s, one of %s"
+                    % (SHA3_BACKEND, ', '.join(sorted(SHA3_BACKENDS))))
+sha3_256 = SHA3_BACKENDS[SHA3_BACKEND]()
+
+
 def sha3(seed):
+    if metrics.ENABLED:
+        metrics.incr('sha3.calls')
     return sha3_256(seed).digest()
 
 